@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import itertools
+import json
+import os
+import platform
+import re
+import subprocess
+import tempfile
+import threading
+import time
+import timeit
+from concurrent.futures import Future
+from types import SimpleNamespace
+from typing import Callable
+
+from telegram import Chat, User
+from telegram.utils.helpers import mention_markdown
+
+import main
+from scheduler import TimerWheel
+from shard import Shards
+from store import ChallengeStore, QuestionStore
+from tokens import derive_key, sign_options
+from utils import (
+    ConfigWriter,
+    Template,
+    escape_markdown,
+    escape_value,
+    load_config,
+    persisted_view,
+)
+
+PASS = "{user} passed the verification.\nQuestion: {question}\nAnswer: {ans}"
+QUESTION = "What is 1 + 1? (Answer with a number!)"
+ANSWER = "2. Obviously_not 3"
+
+
+def legacy_escape_markdown(text: str) -> str:
+    parse = re.sub(r"([_*\[\]()~`>\#\+\-=|\.!])", r"\\\1", text)
+    reparse = re.sub(r"\\\\([_*\[\]()~`>\#\+\-=|\.!])", r"\1", parse)
+    return reparse
+
+
+def legacy_format() -> str:
+    return legacy_escape_markdown(PASS).format(
+        user=mention_markdown(1, "1", version=2),
+        question=legacy_escape_markdown(QUESTION),
+        ans=legacy_escape_markdown(ANSWER),
+    )
+
+
+template = Template(PASS)
+question = escape_markdown(QUESTION)
+
+
+def compiled_format() -> str:
+    return template.format(
+        user=mention_markdown(1, "1", version=2),
+        question=question,
+        ans=escape_value(ANSWER),
+    )
+
+
+def make_config(size: int) -> dict:
+    return dict(
+        TOKEN="1:bench",
+        CHAT=-100,
+        GREET_WINDOW=0,
+        CHALLENGE=[
+            dict(
+                QUESTION=f"Question {num}: what is {num} + 1?",
+                ANSWER=str(num + 1),
+                WRONG=[str(num + 2), str(num + 3), f"{num}_{num}"],
+            )
+            for num in range(size)
+        ],
+    )
+
+
+class StubBot(object):
+    """Bot answering every API call locally, without any network"""
+
+    id = 1
+    token = "1:bench"
+
+    def __init__(self):
+        self.ids = itertools.count(1000)
+
+    def get_chat_administrators(self, chat_id: int) -> list:
+        return [SimpleNamespace(user=User(2, "admin", False, username="admin"))]
+
+    def send_message(self, **kwargs) -> SimpleNamespace:
+        return SimpleNamespace(message_id=next(self.ids))
+
+    def __getattr__(self, name: str) -> Callable:
+        return lambda *args, **kwargs: True
+
+
+class StubOutbox(object):
+    """Outbox running every call inline"""
+
+    def submit(self, priority: int, chat_id: int, func: Callable, /, *args, **kwargs):
+        future: Future = Future()
+        future.set_result(func(*args, **kwargs))
+        return future
+
+
+def make_context(config: dict, directory: str) -> SimpleNamespace:
+    bot = StubBot()
+    outbox = StubOutbox()
+    return SimpleNamespace(
+        bot=bot,
+        bot_data=dict(
+            config=config,
+            snapshots={config.get("version"): config},
+            lock=threading.Lock(),
+            shards=Shards(),
+            secret=derive_key("bench"),
+            wheel=TimerWheel(None),
+            store=ChallengeStore(os.path.join(directory, "bench.db")),
+            outbox=outbox,
+            cleaner=SimpleNamespace(add=lambda chat_id, message_id: None),
+        ),
+        job_queue=None,
+        chat_data=dict(),
+        user_data=dict(),
+    )
+
+
+def bench(func: Callable, number: int, repeat: int = 5) -> float:
+    """Best per-call time in microseconds over repeat runs"""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def run(number: int, sizes: list, directory: str) -> dict:
+    results = dict()
+
+    def record(name: str, func: Callable, number: int, repeat: int = 5) -> None:
+        results[name] = dict(us=bench(func, number, repeat), number=number)
+        print(f"{name}: {results[name]['us']:.2f}us")
+
+    record("format.legacy", legacy_format, number)
+    record("format.compiled", compiled_format, number)
+    record("escape_markdown", lambda: escape_markdown(PASS), number)
+    record("escape_value", lambda: escape_value(ANSWER), number)
+    for size in sizes:
+        config = make_config(size)
+        runs = max(1, min(number, 100000 // size // 10))
+        record(f"load_config.{size}", lambda: load_config(config), runs, 3)
+
+    config = load_config(make_config(100))
+    context = make_context(config, directory)
+    key = context.bot_data.get("secret")
+    challenge = config.get("bank").at(0)
+    deadline = time.time() + 120
+    rows = sign_options(
+        key, -100, 0, challenge.id, (challenge.answer, *challenge.wrong), int(deadline)
+    )
+    data = rows[0][0].callback_data
+    record("query_callback", lambda: main.query_callback(key, data), number)
+    record("admin_callback", lambda: main.admin_callback("admin|pass|12345"), number)
+    record(
+        "private_callback",
+        lambda: main.private_callback("detail_question_private|42"),
+        number,
+    )
+    store = QuestionStore(os.path.join(directory, "questions.db"))
+    store.seed(make_config(max(sizes)).get("CHALLENGE"))
+    record("bank.sample.memory", config.get("bank").sample, number)
+    record(f"bank.sample.store.{len(store)}", store.sample, number)
+    record("bank.search.memory", lambda: config.get("bank").search("5 + 1"), number)
+    record(
+        f"bank.search.store.{len(store)}",
+        lambda: store.search("question 42"),
+        max(1, number // 1000),
+    )
+    store.close()
+    users = [(user_id, f"User {user_id}") for user_id in range(5)]
+    record(
+        "challenge_buttons",
+        lambda: main.challenge_buttons(context, -100, 0, challenge, deadline),
+        number,
+    )
+    record("admin_buttons.5", lambda: main.admin_buttons(config, users), number)
+
+    chat = Chat(-100, "supergroup")
+    members = itertools.count(10000)
+
+    def newmem() -> None:
+        user = User(next(members), "Member", False)
+        message = SimpleNamespace(
+            chat=chat, from_user=user, new_chat_members=[user], message_id=1
+        )
+        main.newmem(SimpleNamespace(message=message), context)
+
+    record("newmem", newmem, max(1, number // 100))
+
+    for size in sizes[:2]:
+        view = load_config(make_config(size))
+        name = os.path.join(directory, f"bench.{size}.yml")
+        record(
+            f"save_config.{size}",
+            lambda: ConfigWriter._write(name, persisted_view(view, "1:bench")),
+            max(1, min(number, 10000 // size // 10)),
+            3,
+        )
+    context.bot_data.get("store").close()
+    return results
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.realpath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Telegram Group Easy Auth bench.")
+    parser.add_argument(
+        "-n",
+        "--number",
+        default=100000,
+        help="calls per run for the fast paths, defaults to 100000",
+        type=int,
+    )
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        default="10,1000,100000",
+        help="question bank sizes for load_config, defaults to 10,1000,100000",
+        type=str,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="benchmark.json",
+        help="file to write the results to, defaults to benchmark.json",
+        type=str,
+    )
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        results = run(
+            args.number, [int(size) for size in args.sizes.split(",")], directory
+        )
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(
+            dict(
+                commit=commit(),
+                time=int(time.time()),
+                python=platform.python_version(),
+                machine=platform.machine(),
+                results=results,
+            ),
+            file,
+            indent=2,
+        )
+    print(f"Results written to {args.output}")
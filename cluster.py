@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import signal
+import threading
+from typing import Callable, Optional
+
+from telegram.ext import Updater
+from telegram.ext.callbackcontext import CallbackContext
+from telegram.update import Update
+
+from ingress import start_dispatcher
+from utils import logger
+
+# Control message telling a worker to reload its config.
+RELOAD = "reload"
+
+
+class Cluster(object):
+    """Front process routing updates by chat ID to forked worker processes"""
+
+    def __init__(self, processes: int, size: int = 10000):
+        self.processes = processes
+        self.index: Optional[int] = None
+        self._queues = [multiprocessing.Queue(size) for _ in range(processes)]
+        self._pids: list = list()
+
+    def shard(self, chat_id: int) -> int:
+        # abs() keeps the shard equal to SQLite's abs(chat_id) % processes.
+        return abs(chat_id) % self.processes
+
+    def fork(self) -> Optional[int]:
+        """Fork every worker, return its index in the worker and None in the front"""
+        for index in range(self.processes):
+            if (pid := os.fork()) == 0:
+                self.index = index
+                return index
+            self._pids.append(pid)
+        return None
+
+    def route(self, update: Update, context: CallbackContext) -> None:
+        chat = update.effective_chat
+        # A full queue blocks here, which pushes back on the front's ingress.
+        self._queues[self.shard(chat.id) if chat else 0].put(update.to_dict())
+
+    def broadcast(self, message: str) -> None:
+        """Send a control message to every other worker"""
+        for index, queue in enumerate(self._queues):
+            if index != self.index:
+                queue.put(message)
+
+    def serve(self, updater: Updater, reload: Callable[[], object]) -> None:
+        """Run the dispatcher of a worker, fed from its queue instead of polling"""
+        start_dispatcher(updater)
+        threading.Thread(
+            target=self._feed, args=(updater, reload), name="Cluster", daemon=True
+        ).start()
+        logger.info(f"Cluster: Worker {self.index} serving pid {os.getpid()}")
+
+    def _feed(self, updater: Updater, reload: Callable[[], object]) -> None:
+        queue = self._queues[self.index]
+        while (data := queue.get()) is not None:
+            if data == RELOAD:
+                reload()
+                continue
+            updater.update_queue.put(Update.de_json(data, updater.bot))
+        # The front is gone, stop through the same path as Ctrl-C.
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def stop(self) -> None:
+        for queue in self._queues:
+            queue.put(None)
+        for pid in self._pids:
+            os.waitpid(pid, 0)
+        logger.info(f"Cluster: Stopped {len(self._pids)} workers")
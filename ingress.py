@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+from collections import deque
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from telegram.ext import Dispatcher, Updater
+from telegram.update import Update
+
+from utils import logger
+
+# Full queue policies: drop the oldest queued update, or refuse the new one
+# with 503 so Telegram delivers it again later.
+DROP_OLDEST, REJECT = "oldest", "reject"
+
+
+def start_dispatcher(updater: Updater) -> None:
+    """Run the dispatcher and job queue of updater without polling or a webhook"""
+    updater.running = True
+    updater.job_queue.start()
+    threading.Thread(
+        target=updater.dispatcher.start, name="dispatcher", daemon=True
+    ).start()
+
+
+def is_sheddable(update: dict) -> bool:
+    """Whether update is group traffic worthless once late, never joins or private"""
+    if message := update.get("message"):
+        if message.get("new_chat_members"):
+            return False
+    elif query := update.get("callback_query"):
+        message = query.get("message")
+    if not isinstance(message, dict):
+        return False
+    return message.get("chat", dict()).get("type") in ("group", "supergroup")
+
+
+class HandlerGate(object):
+    """Bound the updates of dispatcher in flight, from queued to their last handler
+
+    The handlers of an admitted update hold its slot until they all return, so
+    the backlog waits in the ingress queue instead of the unbounded one of
+    run_async.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, slots: int):
+        self.slots = slots
+        self._free = threading.BoundedSemaphore(slots)
+        self._holds: dict = dict()
+        self._lock = threading.Lock()
+        process_update, run_async = dispatcher.process_update, dispatcher.run_async
+        gate = self
+
+        @wraps(process_update)
+        def gated_process_update(update: object) -> None:
+            try:
+                process_update(update)
+            finally:
+                gate._release(update)
+
+        @wraps(run_async)
+        def gated_run_async(func, *args, update: object = None, **kwargs):
+            if update is None or not gate._hold(update):
+                return run_async(func, *args, update=update, **kwargs)
+
+            @wraps(func)
+            def gated(*args, **kwargs):
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    gate._release(update)
+
+            try:
+                return run_async(gated, *args, update=update, **kwargs)
+            except BaseException:
+                gate._release(update)
+                raise
+
+        # Dispatcher warns on new attributes, these only shadow its methods.
+        object.__setattr__(dispatcher, "process_update", gated_process_update)
+        object.__setattr__(dispatcher, "run_async", gated_run_async)
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Wait for a free slot, hand it to admit or give it back with cancel"""
+        return self._free.acquire(timeout=timeout)
+
+    def cancel(self) -> None:
+        self._free.release()
+
+    def admit(self, update: Update) -> None:
+        """Let update hold the acquired slot until its last handler returns"""
+        with self._lock:
+            self._holds[id(update)] = 1
+
+    def _hold(self, update: object) -> bool:
+        with self._lock:
+            if id(update) not in self._holds:
+                return False
+            self._holds[id(update)] += 1
+            return True
+
+    def _release(self, update: object) -> None:
+        with self._lock:
+            if (count := self._holds.get(id(update))) is None:
+                return
+            if count > 1:
+                self._holds[id(update)] = count - 1
+                return
+            del self._holds[id(update)]
+        self._free.release()
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._holds)
+
+
+class Ingress(object):
+    """Webhook server acknowledging at once into a bounded queue with shedding"""
+
+    def __init__(
+        self,
+        updater: Updater,
+        path: str,
+        port: int = 8080,
+        size: int = 10000,
+        max_age: float = 15,
+        policy: str = DROP_OLDEST,
+    ):
+        assert policy in (DROP_OLDEST, REJECT), f"Ingress: Unknown policy {policy}"
+        self.updater = updater
+        self.path = path
+        self.size = size
+        self.max_age = max_age
+        self.policy = policy
+        self.accepted = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.shed = 0
+        self.peak = 0
+        # Queued (stamp, data), updates that may be shed apart from the rest so
+        # a full queue evicts without looking through it.
+        self._kept: deque = deque()
+        self._sheddable: deque = deque()
+        self._cond = threading.Condition()
+        self._stop = False
+        self.gate = HandlerGate(updater.dispatcher, updater.dispatcher.workers)
+        self._server = ThreadingHTTPServer(("0.0.0.0", port), self._handler())
+        self._server.daemon_threads = True
+
+    def _handler(self) -> type:
+        ingress = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                if self.path != ingress.path:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                # Acknowledge once queued, Telegram only needs the status.
+                self.send_response(200 if ingress.put(body) else 503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        return Handler
+
+    def __len__(self) -> int:
+        return len(self._kept) + len(self._sheddable)
+
+    def _evict(self) -> bool:
+        # Joins and private chats are never dropped, evict the oldest update
+        # that is neither.
+        if not self._sheddable:
+            return False
+        self._sheddable.popleft()
+        if self.dropped % 1000 == 0:
+            logger.warning(f"Ingress: Queue full, dropped {self.dropped + 1} updates")
+        self.dropped += 1
+        return True
+
+    def put(self, body: bytes) -> bool:
+        # Parsed once here, outside the lock, neither eviction nor the feed
+        # parses it again.
+        try:
+            data = json.loads(body)
+        except ValueError as err:
+            logger.warning(f"Ingress: Malformed update: {err}")
+            data = None
+        # Anything that is not even an update goes first.
+        sheddable = not isinstance(data, dict) or is_sheddable(data)
+        with self._cond:
+            if len(self) >= self.size and (
+                self.policy == REJECT or not self._evict()
+            ):
+                self.rejected += 1
+                return False
+            queue = self._sheddable if sheddable else self._kept
+            queue.append((time.monotonic(), data))
+            self.accepted += 1
+            self.peak = max(self.peak, len(self))
+            self._cond.notify()
+        return True
+
+    def _oldest(self) -> deque:
+        if not self._sheddable:
+            return self._kept
+        if not self._kept:
+            return self._sheddable
+        return min(self._kept, self._sheddable, key=lambda queue: queue[0][0])
+
+    def _run(self) -> None:
+        while True:
+            # Take a slot first, so the backlog stays here where it is bounded
+            # and aged until a handler is free for it.
+            while not self.gate.acquire(timeout=1):
+                if self._stop:
+                    return
+            with self._cond:
+                while not len(self) and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    self.gate.cancel()
+                    return
+                queue = self._oldest()
+                stamp, data = queue.popleft()
+            if not self._feed(stamp, data, queue is self._sheddable):
+                self.gate.cancel()
+
+    def _feed(self, stamp: float, data: Optional[dict], sheddable: bool) -> bool:
+        """Hand data to the dispatcher, whether it was admitted"""
+        if not isinstance(data, dict):
+            return False
+        if time.monotonic() - stamp > self.max_age and sheddable:
+            if self.shed % 1000 == 0:
+                logger.warning(f"Ingress: Shed {self.shed + 1} stale updates")
+            self.shed += 1
+            return False
+        try:
+            update = Update.de_json(data, self.updater.bot)
+        except Exception as err:
+            logger.warning(f"Ingress: Malformed update: {err}")
+            return False
+        self.gate.admit(update)
+        self.updater.update_queue.put(update)
+        return True
+
+    def stats(self) -> dict:
+        with self._cond:
+            return dict(
+                depth=len(self),
+                peak=self.peak,
+                age=time.monotonic() - self._oldest()[0][0] if len(self) else 0.0,
+                accepted=self.accepted,
+                dropped=self.dropped,
+                rejected=self.rejected,
+                shed=self.shed,
+                in_flight=self.gate.in_flight(),
+            )
+
+    def start(self, webhook_url: Optional[str] = None) -> None:
+        threading.Thread(
+            target=self._server.serve_forever, name="Ingress", daemon=True
+        ).start()
+        threading.Thread(target=self._run, name="IngressFeed", daemon=True).start()
+        if webhook_url:
+            self.updater.bot.set_webhook(webhook_url)
+        logger.info(
+            f"Ingress: Listening on port {self._server.server_port} "
+            f"with a queue of {self.size}, policy {self.policy}"
+        )
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
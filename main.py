@@ -1,21 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import argparse
-import copy
-import datetime
 import os
-import re
+import signal
+import sys
+import tempfile
+import threading
 import time
-from io import BytesIO
+from concurrent.futures import Future
 from random import SystemRandom
-from typing import Optional, Tuple
+from typing import Callable, Optional, Tuple
 
+from apscheduler.executors.pool import ThreadPoolExecutor
 from telegram import (
     CallbackQuery,
     ChatAdministratorRights,
     ChatPermissions,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    Message,
     ParseMode,
     Poll,
 )
@@ -24,9 +27,12 @@ from telegram.ext import (
     CallbackQueryHandler,
     CommandHandler,
     ConversationHandler,
+    Defaults,
+    ExtBot,
     Filters,
     MessageHandler,
     PicklePersistence,
+    TypeHandler,
     Updater,
 )
 from telegram.ext.callbackcontext import CallbackContext
@@ -34,23 +40,48 @@ from telegram.ext.filters import MergedFilter
 from telegram.update import Update
 from telegram.utils.helpers import mention_markdown
 
+from cluster import RELOAD, Cluster
+from ingress import Ingress, start_dispatcher
+from metrics import (
+    HANDLER_LATENCY,
+    SCHEDULER_LAG,
+    VERIFICATIONS,
+    Gauge,
+    MetricsServer,
+    status,
+)
+from outbox import ANSWER, GREET, RESTRICT, Cleaner, Outbox
+from scheduler import TimerWheel
+from shard import Shards
+from store import ChallengeStore
+from tokens import PREFIX, Token, derive_key, option_index, sign_options, verify
+from transport import build_request
+from upload import check_upload, download, join_errors, swap
 from utils import (
+    Challenge,
+    ConfigWriter,
     FullChatPermissions,
+    chat_config,
+    chat_ids,
+    dump_config,
+    escape_value,
     get_chat_admins,
     get_chat_admins_name,
-    load_config,
+    get_chat_admins_record,
+    load_config_file,
     log_to_file,
     log_to_stream,
     logger,
-    yaml,
+    start_logging,
+    stop_logging,
 )
 
-
-def escape_markdown(text: str) -> str:
-    # Use {} and reverse markdown carefully.
-    parse = re.sub(r"([_*\[\]()~`>\#\+\-=|\.!])", r"\\\1", text)
-    reparse = re.sub(r"\\\\([_*\[\]()~`>\#\+\-=|\.!])", r"\1", parse)
-    return reparse
+# Questions per page of the private question list.
+PAGE_SIZE = 10
+# Content hash IDs are never 0, the private flow adds a new question with it.
+NEW_QUESTION = 0
+# Stands in for the answer in a shared greeting while others still answer it.
+HIDDEN_ANSWER = escape_value("***")
 
 
 def start_command(update: Update, context: CallbackContext) -> None:
@@ -58,328 +89,768 @@ def start_command(update: Update, context: CallbackContext) -> None:
     chat = message.chat
     user = message.from_user
     message.reply_text(
-        escape_markdown(context.bot_data.get("config").get("START")).format(
-            chat=chat.id, user=user.id
-        ),
+        chat_config(context.bot_data.get("config"), chat.id)
+        .get("templates")
+        .get("START")
+        .format(chat=chat.id, user=user.id),
         parse_mode=ParseMode.MARKDOWN_V2,
     )
-    logger.info(
-        f"Current Jobs: {[t.id for t in context.job_queue.scheduler.get_jobs()]}"
-    )
+    logger.info(status(context))
 
 
-def kick(context: CallbackContext, chat_id: int, user_id: int) -> bool:
-    if context.bot.ban_chat_member(
-        chat_id=chat_id,
-        user_id=user_id,
-        until_date=int(time.time()) + context.bot_data.get("config").get("BANTIME"),
-    ):
-        logger.info(f"Job kick: Successfully kicked user {user_id} at group {chat_id}")
-        return True
-    else:
-        logger.warning(
-            f"Job kick: No enough permissions to kick user {user_id} at group {chat_id}"
-        )
-        return False
+def report(future: Future, success: str, failure: str, *args) -> Future:
+    """Log success or failure, formatted with args, once future is done"""
 
+    def callback(future: Future) -> None:
+        if future.exception() is None and future.result():
+            logger.info(success, *args)
+        else:
+            logger.warning(failure, *args)
 
-def restore(context: CallbackContext, chat_id: int, user_id: int) -> bool:
-    if context.bot.restrict_chat_member(
-        chat_id=chat_id,
-        user_id=user_id,
-        permissions=FullChatPermissions,
-    ):
-        logger.info(
-            f"Job restore: Successfully restored user {user_id} at group {chat_id}"
-        )
-        return True
-    else:
-        logger.warning(
-            f"Job restore: No enough permissions to restore user {user_id} at group {chat_id}"
-        )
-        return False
+    future.add_done_callback(callback)
+    return future
 
 
-def clean(
-    context: CallbackContext, chat_id: int, user_id: int, message_id: int
-) -> bool:
-    if context.bot.delete_message(chat_id=chat_id, message_id=message_id):
-        logger.info(
-            f"Job clean: Successfully delete message {message_id} from {user_id} at group {chat_id}"
-        )
-        return True
-    else:
-        logger.warning(
-            f"Job clean: No enough permissions to delete message {message_id} from {user_id} at group {chat_id}"
-        )
-        return False
+def kick(context: CallbackContext, chat_id: int, user_id: int) -> Future:
+    return report(
+        context.bot_data.get("outbox").submit(
+            RESTRICT,
+            None,
+            context.bot.ban_chat_member,
+            chat_id=chat_id,
+            user_id=user_id,
+            until_date=int(time.time())
+            + chat_config(context.bot_data.get("config"), chat_id).get("BANTIME"),
+        ),
+        "Job kick: Successfully kicked user %s at group %s",
+        "Job kick: No enough permissions to kick user %s at group %s",
+        user_id,
+        chat_id,
+    )
+
+
+def restore(context: CallbackContext, chat_id: int, user_id: int) -> Future:
+    return report(
+        context.bot_data.get("outbox").submit(
+            RESTRICT,
+            None,
+            context.bot.restrict_chat_member,
+            chat_id=chat_id,
+            user_id=user_id,
+            permissions=FullChatPermissions,
+        ),
+        "Job restore: Successfully restored user %s at group %s",
+        "Job restore: No enough permissions to restore user %s at group %s",
+        user_id,
+        chat_id,
+    )
+
 
+def clean(context: CallbackContext, chat_id: int, message_id: int) -> None:
+    context.bot_data.get("cleaner").add(chat_id, message_id)
 
+
+@HANDLER_LATENCY.timer(handler="newmem")
 def newmem(update: Update, context: CallbackContext) -> None:
     message = update.message
     chat = message.chat
+    config = chat_config(context.bot_data.get("config"), chat.id)
     if message.from_user.id in get_chat_admins(
         context.bot,
         chat.id,
-        extra_user=context.bot_data.get("config").get("SUPER_ADMIN"),
+        extra_user=config.get("SUPER_ADMIN"),
     ):
         return
+    users = list()
     for user in message.new_chat_members:
         if user.is_bot:
             continue
-        num = SystemRandom().randint(
-            0, len(context.bot_data.get("config").get("CHALLENGE")) - 1
-        )
-        flag = context.bot_data.get("config").get("CHALLENGE")[num]
-        if context.bot.restrict_chat_member(
-            chat_id=chat.id,
-            user_id=user.id,
-            permissions=ChatPermissions(can_send_messages=False),
-        ):
-            logger.info(
-                f"New member: Successfully restricted user {user.id} at group {chat.id}"
-            )
+        report(
+            context.bot_data.get("outbox").submit(
+                RESTRICT,
+                None,
+                context.bot.restrict_chat_member,
+                chat_id=chat.id,
+                user_id=user.id,
+                permissions=ChatPermissions(can_send_messages=False),
+            ),
+            "New member: Successfully restricted user %s at group %s",
+            "New member: No enough permissions to restrict user %s at group %s",
+            user.id,
+            chat.id,
+        )
+        users.append((user, message.message_id))
+    if not users:
+        return
+    shard = context.bot_data.get("shards").get(chat.id)
+    now = time.time()
+    with shard.lock:
+        if threshold := config.get("RAID_THRESHOLD"):
+            shard.joined.extend(now for _ in users)
+            while shard.joined[0] < now - config.get("RAID_WINDOW"):
+                shard.joined.popleft()
+            raid = shard.raid is not None or len(shard.joined) >= threshold
         else:
-            logger.warning(
-                f"New member: No enough permissions to restrict user {user.id} at group {chat.id}"
-            )
-        buttons = [
-            [
-                InlineKeyboardButton(
-                    flag.get("WRONG")[t],
-                    callback_data=f"challenge|{user.id}|{num}|{flag.get('wrong')[t]}",
-                )
-            ]
-            for t in range(len(flag.get("WRONG")))
-        ]
-        buttons.append(
-            [
-                InlineKeyboardButton(
-                    flag.get("ANSWER"),
-                    callback_data=f"challenge|{user.id}|{num}|{flag.get('answer')}",
+            raid = False
+        if not raid:
+            first = not shard.joins
+            shard.joins.extend(users)
+    if raid:
+        raid_join(context, chat.id, users)
+    elif not config.get("GREET_WINDOW"):
+        greet(context, chat.id)
+    elif first:
+        context.job_queue.run_once(
+            lambda job_context: greet(job_context, chat.id),
+            config.get("GREET_WINDOW"),
+            name=f"{chat.id}|greet",
+        )
+
+
+def greet(context: CallbackContext, chat_id: int) -> None:
+    shard = context.bot_data.get("shards").get(chat_id)
+    with shard.lock:
+        joins, shard.joins = shard.joins, list()
+    size = chat_config(context.bot_data.get("config"), chat_id).get("GREET_BATCH")
+    for t in range(0, len(joins), size):
+        greet_batch(context, chat_id, joins[t : t + size])
+
+
+def raid_join(context: CallbackContext, chat_id: int, users: list) -> None:
+    """Add users to the pinned raid challenge, posting it on the first join"""
+    shard = context.bot_data.get("shards").get(chat_id)
+    with shard.lock:
+        if owner := shard.raid is None:
+            shard.raid = Future()
+        raid = shard.raid
+    if owner:
+        start_raid(context, chat_id, raid, len(shard.joined))
+
+    def joined(raid: Future) -> None:
+        message_id = None if raid.exception() else raid.result()
+        with shard.lock:
+            challenge = shard.challenges.get(message_id)
+            if challenge:
+                challenge.get("users").update(
+                    {user.id: join_id for user, join_id in users}
                 )
-            ]
+        if not challenge:
+            # The raid ended meanwhile or never started, greet them one by one.
+            greet_batch(context, chat_id, users)
+            return
+        context.bot_data.get("store").add(
+            chat_id,
+            message_id,
+            challenge.get("question"),
+            challenge.get("text"),
+            challenge.get("deadline"),
+            [(user.id, join_id, user.first_name) for user, join_id in users],
+            raid=True,
         )
-        SystemRandom().shuffle(buttons)
-        buttons.append(
-            [
-                InlineKeyboardButton(
-                    context.bot_data.get("config").get("PASS_BTN"),
-                    callback_data=f"admin|pass|{user.id}",
-                ),
-                InlineKeyboardButton(
-                    context.bot_data.get("config").get("KICK_BTN"),
-                    callback_data=f"admin|kick|{user.id}",
-                ),
-            ]
+
+    # Joins wait for the raid message without holding a worker.
+    raid.add_done_callback(joined)
+
+
+def start_raid(
+    context: CallbackContext, chat_id: int, raid: Future, joins: int
+) -> None:
+    config = chat_config(context.bot_data.get("config"), chat_id)
+    shard = context.bot_data.get("shards").get(chat_id)
+    challenge = config.get("bank").sample()
+    deadline = time.time() + config.get("RAID_TIME")
+    buttons = challenge_buttons(context, chat_id, 0, challenge, deadline)
+    text = (
+        config.get("templates")
+        .get("RAID")
+        .format(question=challenge.markdown, time=config.get("RAID_TIME"))
+    )
+
+    def sent(future: Future) -> None:
+        if err := future.exception():
+            with shard.lock:
+                shard.raid = None
+            raid.set_exception(err)
+            return
+        question_message = future.result()
+        context.bot_data.get("outbox").submit(
+            GREET,
+            chat_id,
+            context.bot.pin_chat_message,
+            chat_id=chat_id,
+            message_id=question_message.message_id,
+            disable_notification=True,
+        )
+        with shard.lock:
+            shard.challenges[question_message.message_id] = dict(
+                lock=threading.Lock(),
+                text=text.rstrip("\n"),
+                buttons=buttons,
+                admin_buttons=dict(),
+                users=dict(),
+                results=list(),
+                clean=set(),
+                version=config.get("version"),
+                raid=True,
+                question=challenge.id,
+                deadline=deadline,
+                edits=0,
+                editing=False,
+                claims=0,
+            )
+        context.bot_data.get("store").add(
+            chat_id,
+            question_message.message_id,
+            challenge.id,
+            text.rstrip("\n"),
+            deadline,
+            [],
+            raid=True,
+        )
+        context.bot_data.get("wheel").add(
+            (chat_id, question_message.message_id), deadline, deadline
+        )
+        raid.set_result(question_message.message_id)
+        logger.warning(
+            "Raid: Entered raid mode at group %s after %d joins in %ss, "
+            "sweeping in %ss",
+            chat_id,
+            joins,
+            config.get("RAID_WINDOW"),
+            config.get("RAID_TIME"),
         )
-        question_message = message.reply_text(
-            escape_markdown(context.bot_data.get("config").get("GREET")).format(
-                question=escape_markdown(flag.get("QUESTION")),
-                time=context.bot_data.get("config").get("TIME"),
+
+    context.bot_data.get("outbox").submit(
+        GREET,
+        chat_id,
+        context.bot.send_message,
+        chat_id=chat_id,
+        text=text,
+        reply_markup=InlineKeyboardMarkup(buttons),
+        parse_mode=ParseMode.MARKDOWN_V2,
+    ).add_done_callback(sent)
+
+
+def challenge_buttons(
+    context: CallbackContext,
+    chat_id: int,
+    user_id: int,
+    challenge: Challenge,
+    deadline: float,
+) -> list:
+    """Signed answer buttons, user_id 0 lets any pending member of the message answer"""
+    buttons = sign_options(
+        context.bot_data.get("secret"),
+        chat_id,
+        user_id,
+        challenge.id,
+        (challenge.answer, *challenge.wrong),
+        int(deadline) + 1,
+    )
+    SystemRandom().shuffle(buttons)
+    return buttons
+
+
+def admin_buttons(config: dict, users: list) -> dict:
+    return {
+        user_id: [
+            InlineKeyboardButton(
+                config.get("PASS_BTN")
+                if len(users) == 1
+                else f"{config.get('PASS_BTN')} {name}",
+                callback_data=f"admin|pass|{user_id}",
+            ),
+            InlineKeyboardButton(
+                config.get("KICK_BTN")
+                if len(users) == 1
+                else f"{config.get('KICK_BTN')} {name}",
+                callback_data=f"admin|kick|{user_id}",
             ),
-            reply_markup=InlineKeyboardMarkup(buttons),
-            parse_mode=ParseMode.MARKDOWN_V2,
-        )
-        context.job_queue.scheduler.add_job(
-            kick,
-            "date",
-            id=f"{chat.id}|{user.id}|kick",
-            name=f"{chat.id}|{user.id}|kick",
-            args=[context, chat.id, user.id],
-            run_date=context.job_queue._tz_now()
-            + datetime.timedelta(seconds=context.bot_data.get("config").get("TIME")),
-            replace_existing=True,
-        )
-        context.job_queue.scheduler.add_job(
-            clean,
-            "date",
-            id=f"{chat.id}|{user.id}|clean_join",
-            name=f"{chat.id}|{user.id}|clean_join",
-            args=[context, chat.id, user.id, message.message_id],
-            run_date=context.job_queue._tz_now()
-            + datetime.timedelta(seconds=context.bot_data.get("config").get("TIME")),
-            replace_existing=True,
-        )
-        context.job_queue.scheduler.add_job(
-            clean,
-            "date",
-            id=f"{chat.id}|{user.id}|clean_question",
-            name=f"{chat.id}|{user.id}|clean_question",
-            args=[context, chat.id, user.id, question_message.message_id],
-            run_date=context.job_queue._tz_now()
-            + datetime.timedelta(seconds=context.bot_data.get("config").get("TIME")),
-            replace_existing=True,
+        ]
+        for user_id, name in users
+    }
+
+
+def greet_batch(context: CallbackContext, chat_id: int, users: list) -> None:
+    config = chat_config(context.bot_data.get("config"), chat_id)
+    challenge = config.get("bank").sample()
+    deadline = time.time() + config.get("TIME")
+    buttons = challenge_buttons(
+        context, chat_id, users[0][0].id if len(users) == 1 else 0, challenge, deadline
+    )
+    admins = admin_buttons(config, [(user.id, user.first_name) for user, _ in users])
+    mentions = " ".join(user.mention_markdown_v2() for user, _ in users)
+    text = (
+        config.get("templates")
+        .get("GREET")
+        .format(question=challenge.markdown, time=config.get("TIME"), user=mentions)
+    )
+    if len(users) > 1:
+        text = f"{mentions}\n{text}"
+    shard = context.bot_data.get("shards").get(chat_id)
+
+    def sent(future: Future) -> None:
+        if future.exception():
+            return
+        question_message = future.result()
+        logger.info(
+            "New member: Greeted %s at group %s",
+            [user.id for user, _ in users],
+            chat_id,
+            extra=dict(event="greet", chat=chat_id),
+        )
+        with shard.lock:
+            shard.challenges[question_message.message_id] = dict(
+                lock=threading.Lock(),
+                text=text.rstrip("\n"),
+                buttons=buttons,
+                admin_buttons=admins,
+                users={user.id: message_id for user, message_id in users},
+                results=list(),
+                clean=set(),
+                version=config.get("version"),
+                question=challenge.id,
+                deadline=deadline,
+                edits=0,
+                editing=False,
+                claims=0,
+            )
+        context.bot_data.get("store").add(
+            chat_id,
+            question_message.message_id,
+            challenge.id,
+            text.rstrip("\n"),
+            deadline,
+            [(user.id, message_id, user.first_name) for user, message_id in users],
+        )
+        context.bot_data.get("wheel").add(
+            (chat_id, question_message.message_id), deadline, deadline
         )
 
+    # Registered once sent, the chat's rate limit never holds this worker.
+    context.bot_data.get("outbox").submit(
+        GREET,
+        chat_id,
+        context.bot.send_message,
+        chat_id=chat_id,
+        text=text,
+        reply_to_message_id=users[0][1],
+        allow_sending_without_reply=True,
+        reply_markup=InlineKeyboardMarkup(buttons + list(admins.values())),
+        parse_mode=ParseMode.MARKDOWN_V2,
+    ).add_done_callback(sent)
 
-def quiz_command(update: Update, context: CallbackContext) -> None:
-    num = SystemRandom().randint(
-        0, len(context.bot_data.get("config").get("CHALLENGE")) - 1
+
+def expire(context: CallbackContext, expired: list) -> None:
+    now = time.time()
+    for (chat_id, message_id), deadline in expired:
+        if deadline:
+            SCHEDULER_LAG.observe(now - deadline)
+        shard = context.bot_data.get("shards").get(chat_id)
+        with shard.lock:
+            challenge = shard.challenges.pop(message_id, None)
+            if challenge and challenge.get("raid"):
+                shard.raid = None
+        if not challenge:
+            continue
+        with challenge.get("lock"):
+            users = challenge.get("users")
+            challenge["users"] = dict()
+        for user_id, join_id in users.items():
+            challenge.get("clean").add(join_id)
+            kick(context, chat_id, user_id)
+        VERIFICATIONS.inc(len(users), result="timeout")
+        if challenge.get("raid"):
+            logger.warning(
+                "Raid: Left raid mode at group %s, swept %d members",
+                chat_id,
+                len(users),
+            )
+        for clean_id in [message_id, *challenge.get("clean")]:
+            clean(context, chat_id, clean_id)
+        context.bot_data.get("store").remove(chat_id, message_id)
+    logger.info("Job expire: Expired %d challenges", len(expired))
+    if len(context.bot_data.get("snapshots")) > 1:
+        collect_snapshots(context)
+
+
+def replay(context: CallbackContext) -> None:
+    overdue, pending = list(), list()
+    now = time.time()
+    cluster = context.bot_data.get("cluster")
+    for row in context.bot_data.get("store").load(
+        shard=(cluster.index, cluster.processes) if cluster else None
+    ):
+        key = (row.get("chat_id"), row.get("message_id"))
+        config = chat_config(context.bot_data.get("config"), key[0])
+        users = row.get("users")
+        raid = row.get("raid")
+        # Signed tokens outlive a restart, the sent keyboard stays valid as long
+        # as its question is still in the bank, None keeps it as on the message.
+        stale = config.get("bank").get(row.get("question")) is None
+        # Raid messages are shared by every joiner and carry no admin buttons.
+        admins = admin_buttons(
+            config,
+            [] if raid else [(user_id, name) for user_id, (_, name) in users.items()],
+        )
+        shard = context.bot_data.get("shards").get(key[0])
+        with shard.lock:
+            if raid and row.get("deadline") > now:
+                # Later joins are added to the pinned raid message again.
+                shard.raid = Future()
+                shard.raid.set_result(key[1])
+            shard.challenges[key[1]] = dict(
+                lock=threading.Lock(),
+                text=row.get("text"),
+                buttons=list() if stale else None,
+                admin_buttons=admins,
+                users={
+                    user_id: join_id
+                    for user_id, (join_id, _) in row.get("users").items()
+                },
+                results=list(),
+                clean=row.get("clean"),
+                version=config.get("version"),
+                deadline=row.get("deadline"),
+                edits=0,
+                editing=False,
+                claims=0,
+                raid=raid,
+                question=row.get("question"),
+            )
+        if row.get("deadline") <= now:
+            overdue.append((key, None))
+            continue
+        pending.append((key, row.get("deadline")))
+        if stale and (users or raid):
+            # The question was deleted meanwhile, its options can not be answered.
+            context.bot_data.get("outbox").submit(
+                GREET,
+                key[0],
+                context.bot.edit_message_reply_markup,
+                chat_id=key[0],
+                message_id=key[1],
+                reply_markup=InlineKeyboardMarkup(list(admins.values())),
+            )
+    context.bot_data.get("wheel").add_many(pending)
+    expire(context, overdue)
+    logger.info(
+        f"Store: Replayed {len(overdue)} overdue and re-armed {len(pending)} pending challenges"
     )
-    flag = context.bot_data.get("config").get("CHALLENGE")[num]
-    answer = [flag.get("WRONG")[t] for t in range(len(flag.get("WRONG")))]
+
+
+def claim(
+    context: CallbackContext, chat_id: int, message_id: int, user_id: int
+) -> Optional[Tuple[dict, int]]:
+    """Take user_id off the pending members of a challenge, with its join message
+
+    Only the first press or admin action claims a member, every later one finds
+    nothing and gets no verdict of its own.
+    """
+    shard = context.bot_data.get("shards").get(chat_id)
+    with shard.lock:
+        challenge = shard.challenges.get(message_id)
+    if not challenge:
+        return None
+    with challenge.get("lock"):
+        if (join_id := challenge.get("users").pop(user_id, None)) is None:
+            return None
+        challenge.get("admin_buttons").pop(user_id, None)
+        challenge["claims"] += 1
+    return challenge, join_id
+
+
+def resolve(
+    context: CallbackContext,
+    message: Message,
+    claimed: Tuple[dict, int],
+    user_id: int,
+    result: bool,
+    text: str,
+    hidden: Optional[str] = None,
+) -> None:
+    """Record the result of a claimed user_id, hidden replaces text until all are in"""
+    challenge, join_id = claimed
+    with challenge.get("lock"):
+        challenge["claims"] -= 1
+        if not result:
+            challenge.get("clean").add(join_id)
+        challenge.get("results").append(
+            (text.rstrip("\n"), (hidden or text).rstrip("\n"))
+        )
+        context.bot_data.get("store").resolve(
+            message.chat.id, message.message_id, user_id, result
+        )
+        if challenge.get("raid"):
+            # The pinned raid message stays as is, answers are only counted.
+            return
+        challenge["edits"] += 1
+        if send := not challenge.get("editing"):
+            challenge["editing"] = True
+    # Once all are in, the results stay readable until expire cleans them up.
+    if send:
+        edit(context, message, challenge)
+
+
+def edit(context: CallbackContext, message: Message, challenge: dict) -> None:
+    """Send the latest results of challenge, one edit of its message at a time"""
+    with challenge.get("lock"):
+        edits = challenge.get("edits")
+        if challenge.get("users"):
+            text = "\n\n".join(
+                [challenge.get("text")]
+                + [hidden for _, hidden in challenge.get("results")]
+            )
+            buttons = challenge.get("buttons")
+            if buttons is None:
+                # Replayed, the answer rows are still the ones on the message.
+                buttons = [
+                    row
+                    for row in message.reply_markup.inline_keyboard
+                    if row[0].callback_data.startswith(PREFIX)
+                ]
+            markup = InlineKeyboardMarkup(
+                buttons + list(challenge.get("admin_buttons").values())
+            )
+        else:
+            text = "\n\n".join(text for text, _ in challenge.get("results"))
+            markup = None
+
+    def sent(future: Future) -> None:
+        with challenge.get("lock"):
+            if challenge.get("edits") == edits:
+                challenge["editing"] = False
+                return
+        # Results came in while this edit was out, the next one carries them all.
+        edit(context, message, challenge)
+
+    context.bot_data.get("outbox").submit(
+        GREET,
+        message.chat.id,
+        message.edit_text,
+        text,
+        reply_markup=markup,
+        parse_mode=ParseMode.MARKDOWN_V2,
+    ).add_done_callback(sent)
+
+
+def quiz_command(update: Update, context: CallbackContext) -> None:
+    config = chat_config(context.bot_data.get("config"), update.effective_chat.id)
+    challenge = config.get("bank").sample()
+    answer = list(challenge.wrong)
     SystemRandom().shuffle(answer)
     index = SystemRandom().randint(0, len(answer) - 1)
-    answer.insert(index, flag.get("ANSWER"))
+    answer.insert(index, challenge.answer)
     update.effective_message.reply_poll(
-        flag.get("QUESTION"),
+        challenge.question,
         answer,
         correct_option_id=index,
         is_anonymous=False,
-        open_period=context.bot_data.get("config").get("QUIZTIME"),
+        open_period=config.get("QUIZTIME"),
         type=Poll.QUIZ,
     )
 
 
-def query(update: Update, context: CallbackContext) -> None:
-    def query_callback(
-        context: CallbackContext, rawstr: str
-    ) -> Tuple[int, bool, str, str]:
-        data = rawstr.split("|")
-        logger.info(f"Parse Callback: {data}")
-        user_id = int(data[1])
-        number = int(data[2])
-        answer = str()
-        answer_encode = data[3]
-        question = (
-            context.bot_data.get("config").get("CHALLENGE")[number].get("QUESTION")
-        )
-        if answer_encode == context.bot_data.get("config").get("CHALLENGE")[number].get(
-            "answer"
-        ):
-            result = True
-            answer = (
-                context.bot_data.get("config").get("CHALLENGE")[number].get("ANSWER")
-            )
-        else:
-            result = False
-            for t in range(
-                len(
-                    context.bot_data.get("config").get("CHALLENGE")[number].get("wrong")
-                )
-            ):
-                if (
-                    answer_encode
-                    == context.bot_data.get("config")
-                    .get("CHALLENGE")[number]
-                    .get("wrong")[t]
-                ):
-                    answer = (
-                        context.bot_data.get("config")
-                        .get("CHALLENGE")[number]
-                        .get("WRONG")[t]
-                    )
-                    break
-        logger.info(
-            f"New challenge parse callback:\nuser_id: {user_id}\nresult: {result}\nquestion: {question}\nanswer: {answer}"
-        )
-        return user_id, result, question, answer
+def query_callback(key: bytes, rawstr: str) -> Optional[Token]:
+    token = verify(key, rawstr)
+    logger.debug("Parse Callback: %s", token)
+    return token
+
+
+def find_challenge(
+    context: CallbackContext, pending: dict, chat_id: int, question: int
+) -> Optional[Challenge]:
+    if challenge := chat_config(context.bot_data.get("config"), chat_id).get(
+        "bank"
+    ).get(question):
+        return challenge
+    # An edited question lives on in the snapshot its keyboard was issued from.
+    if snapshot := context.bot_data.get("snapshots").get(pending.get("version")):
+        return chat_config(snapshot, chat_id).get("bank").get(question)
+    return None
+
 
+@HANDLER_LATENCY.timer(handler="query")
+def query(update: Update, context: CallbackContext) -> None:
     callback_query = update.callback_query
     user = callback_query.from_user
     message = callback_query.message
     chat = message.chat
-    user_id, result, question, answer = query_callback(context, callback_query.data)
-    if user.id != user_id:
-        callback_query.answer(
-            text=context.bot_data.get("config").get("OTHER"),
+    config = chat_config(context.bot_data.get("config"), chat.id)
+    token = query_callback(context.bot_data.get("secret"), callback_query.data)
+    challenge = claimed = None
+    if (
+        token
+        and token.chat_id == chat.id
+        and token.user_id in (0, user.id)
+        and token.expiry >= time.time()
+    ):
+        shard = context.bot_data.get("shards").get(chat.id)
+        with shard.lock:
+            pending = shard.challenges.get(message.message_id)
+        # Tokens are only valid on the message they were issued for, another
+        # pending message of the chat asks another question.
+        if (
+            pending
+            and user.id in pending.get("users")
+            and pending.get("question") == token.question
+            and not pending.get("locked")
+        ):
+            challenge = find_challenge(context, pending, chat.id, token.question)
+        if challenge:
+            # Claimed before restore or kick is sent, a second press gets OTHER.
+            claimed = claim(context, chat.id, message.message_id, user.id)
+    if not claimed:
+        context.bot_data.get("outbox").submit(
+            ANSWER,
+            None,
+            callback_query.answer,
+            text=config.get("OTHER"),
             show_alert=True,
         )
         return
+    index = option_index(
+        context.bot_data.get("secret"), token, len(challenge.wrong) + 1
+    )
+    result = index == 0
+    answer = challenge.answer if result else challenge.wrong[index - 1]
+    if not result and token.user_id == 0 and not pending.get("raid"):
+        # A batch shares one keyboard, once an option is known to be wrong the
+        # others can not try the rest, only admins can still let them in.
+        with pending.get("lock"):
+            pending["locked"] = True
+            pending["buttons"] = list()
+    logger.info(
+        "New challenge parse callback:\nquestion: %s\nresult: %s\nanswer: %s",
+        challenge.question,
+        result,
+        answer,
+        extra=dict(
+            event="verify",
+            chat=chat.id,
+            user=user.id,
+            question=challenge.id,
+            result=result,
+        ),
+    )
+    VERIFICATIONS.inc(result="pass" if result else "fail")
     cqconf = (
-        context.bot_data.get("config").get("SUCCESS")
+        config.get("SUCCESS")
         if result
-        else context.bot_data.get("config")
-        .get("RETRY")
-        .format(time=context.bot_data.get("config").get("BANTIME"))
+        else config.get("RETRY").format(time=config.get("BANTIME"))
     )
-    callback_query.answer(
+    context.bot_data.get("outbox").submit(
+        ANSWER,
+        None,
+        callback_query.answer,
         text=cqconf,
         show_alert=False if result else True,
     )
+    fields = dict(user=user.mention_markdown_v2(), question=challenge.markdown)
+
+    def resolved(name: str) -> None:
+        conf = config.get("templates").get(name)
+        resolve(
+            context,
+            message,
+            claimed,
+            user.id,
+            result,
+            conf.format(ans=escape_value(answer), **fields),
+            conf.format(ans=HIDDEN_ANSWER, **fields),
+        )
+
     if result:
-        conf = context.bot_data.get("config").get("PASS")
-        restore(context, chat.id, user_id)
-        if schedule := context.job_queue.scheduler.get_job(
-            f"{chat.id}|{user.id}|clean_join"
-        ):
-            schedule.remove()
+        restore(context, chat.id, user.id)
+        resolved("PASS")
     else:
-        if kick(context, chat.id, user_id):
-            conf = context.bot_data.get("config").get("KICK")
-        else:
-            conf = context.bot_data.get("config").get("NOT_KICK")
-    message.edit_text(
-        escape_markdown(conf).format(
-            user=user.mention_markdown_v2(),
-            question=escape_markdown(question),
-            ans=escape_markdown(answer),
-        ),
-        parse_mode=ParseMode.MARKDOWN_V2,
+        # Resolved once the ban is answered, without holding this worker.
+        kick(context, chat.id, user.id).add_done_callback(
+            lambda future: resolved(
+                "KICK"
+                if future.exception() is None and future.result()
+                else "NOT_KICK"
+            )
+        )
+
+
+def admin_callback(rawstr: str) -> Tuple[bool, int]:
+    data = rawstr.split("|")
+    logger.debug("Parse Callback: %s", data)
+    if data[1] == "pass":
+        result = True
+    else:
+        result = False
+    user_id = int(data[2])
+    logger.info(
+        "New admin parse callback:\nuser_id: %s\nresult: %s",
+        user_id,
+        result,
+        extra=dict(event="admin_verify", user=user_id, result=result),
     )
-    if schedule := context.job_queue.scheduler.get_job(f"{chat.id}|{user.id}|kick"):
-        schedule.remove()
+    return result, user_id
 
 
+@HANDLER_LATENCY.timer(handler="admin")
 def admin(update: Update, context: CallbackContext) -> None:
-    def admin_callback(rawstr: str) -> Tuple[bool, int]:
-        data = rawstr.split("|")
-        logger.info(f"Parse Callback: {data}")
-        if data[1] == "pass":
-            result = True
-        else:
-            result = False
-        user_id = int(data[2])
-        logger.info(f"New admin parse callback:\nuser_id: {user_id}\nresult: {result}")
-        return result, user_id
-
     callback_query = update.callback_query
     user = callback_query.from_user
     message = callback_query.message
     chat = message.chat
+    config = chat_config(context.bot_data.get("config"), chat.id)
     if user.id not in get_chat_admins(
         context.bot,
         chat.id,
-        extra_user=context.bot_data.get("config").get("SUPER_ADMIN"),
+        extra_user=config.get("SUPER_ADMIN"),
     ):
-        callback_query.answer(
-            text=context.bot_data.get("config").get("OTHER"),
+        context.bot_data.get("outbox").submit(
+            ANSWER,
+            None,
+            callback_query.answer,
+            text=config.get("OTHER"),
             show_alert=True,
         )
         return
     result, user_id = admin_callback(callback_query.data)
-    cqconf = (
-        context.bot_data.get("config").get("PASS_BTN")
-        if result
-        else context.bot_data.get("config").get("KICK_BTN")
-    )
+    if not (claimed := claim(context, chat.id, message.message_id, user_id)):
+        # Answered or handled by another admin meanwhile.
+        context.bot_data.get("outbox").submit(
+            ANSWER,
+            None,
+            callback_query.answer,
+            text=config.get("OTHER"),
+            show_alert=True,
+        )
+        return
+    VERIFICATIONS.inc(result="admin_pass" if result else "admin_kick")
+    cqconf = config.get("PASS_BTN") if result else config.get("KICK_BTN")
     conf = (
-        context.bot_data.get("config").get("ADMIN_PASS")
+        config.get("templates").get("ADMIN_PASS")
         if result
-        else context.bot_data.get("config").get("ADMIN_KICK")
+        else config.get("templates").get("ADMIN_KICK")
     )
-    callback_query.answer(
+    context.bot_data.get("outbox").submit(
+        ANSWER,
+        None,
+        callback_query.answer,
         text=cqconf,
         show_alert=False,
     )
     if result:
         restore(context, chat.id, user_id)
-        if schedule := context.job_queue.scheduler.get_job(
-            f"{chat.id}|{user_id}|clean_join"
-        ):
-            schedule.remove()
     else:
         kick(context, chat.id, user_id)
-    message.edit_text(
-        escape_markdown(conf).format(
+    resolve(
+        context,
+        message,
+        claimed,
+        user_id,
+        result,
+        conf.format(
             admin=user.mention_markdown_v2(),
             user=mention_markdown(user_id, str(user_id), version=2),
         ),
-        parse_mode=ParseMode.MARKDOWN_V2,
     )
-    if schedule := context.job_queue.scheduler.get_job(f"{chat.id}|{user_id}|kick"):
-        schedule.remove()
 
 
 def admin_command(update: Update, context: CallbackContext) -> None:
@@ -391,6 +862,7 @@ def private_callback(rawstr: str) -> int:
     data = rawstr.split("|")
     logger.info(f"Parse Callback: {data}")
     if data[0] in [
+        "list_question_private",
         "detail_question_private",
         "edit_question_private",
         "delete_question_private",
@@ -404,10 +876,124 @@ def private_callback(rawstr: str) -> int:
 
 def reload_private(update: Update, context: CallbackContext) -> None:
     message = update.message
+    if not global_admin(context, message.from_user.id):
+        unauthorized(update, context)
+        return
     logger.info(f"Private: Reloaded config")
     message.reply_text(reload_config(context))
 
 
+def managed_chats(context: CallbackContext, user_id: int) -> list:
+    chats = list()
+    for chat_id in chat_ids(context.bot_data.get("config")):
+        try:
+            admins = get_chat_admins(
+                context.bot,
+                chat_id,
+                extra_user=context.bot_data.get("config").get("SUPER_ADMIN"),
+            )
+        except BadRequest as err:
+            logger.warning(f"Private: Skipped group {chat_id}: {err}")
+            continue
+        if user_id in admins:
+            chats.append(chat_id)
+    return chats
+
+
+def global_admin(context: CallbackContext, user_id: int) -> bool:
+    """Whether user_id may act on the whole config, being an admin of every chat"""
+    config = context.bot_data.get("config")
+    if user_id == config.get("SUPER_ADMIN"):
+        return True
+    chats = set(chat_ids(config))
+    return bool(chats) and chats <= set(managed_chats(context, user_id))
+
+
+def may_edit_bank(context: CallbackContext, user_id: int) -> bool:
+    """Whether user_id admins every chat asking the questions of the picked chat"""
+    config = context.bot_data.get("config")
+    bank = chat_bank(context)
+    # Chats without their own CHALLENGE share one bank, editing it edits theirs.
+    sharing = {
+        chat_id
+        for chat_id in chat_ids(config)
+        if chat_config(config, chat_id).get("bank") is bank
+    }
+    return sharing <= set(managed_chats(context, user_id))
+
+
+def unauthorized(update: Update, context: CallbackContext) -> int:
+    logger.info(f"Private: User {update.effective_user.id} is unauthorized, blocking")
+    update.effective_message.reply_text(
+        context.bot_data.get("config").get("START_UNAUTHORIZED_PRIVATE")
+    )
+    return ConversationHandler.END
+
+
+def chat_bank(context: CallbackContext):
+    """Question bank of the chat picked in the private conversation"""
+    return chat_config(
+        context.bot_data.get("config"), context.user_data.get("chat")
+    ).get("bank")
+
+
+def question_number(context: CallbackContext, question: int) -> int:
+    """1-based position of question in its bank, a new question goes last"""
+    bank = chat_bank(context)
+    position = bank.position(question)
+    return len(bank) + 1 if position is None else position + 1
+
+
+def question_page(context: CallbackContext) -> Tuple[str, InlineKeyboardMarkup]:
+    """Text and keyboard of the current page of the question list or search"""
+    config = context.bot_data.get("config")
+    bank = chat_bank(context)
+    text = context.user_data.get("search")
+    matches = None if text is None else bank.search(text)
+    total = len(bank) if matches is None else len(matches)
+    pages = max(1, -(-total // PAGE_SIZE))
+    page = min(context.user_data.get("page", 0), pages - 1)
+    context.user_data.update(page=page)
+    offset = page * PAGE_SIZE
+    challenges = (
+        bank.page(offset, PAGE_SIZE)
+        if matches is None
+        else [bank.get(question) for question in matches[offset : offset + PAGE_SIZE]]
+    )
+    keyboard = [[InlineKeyboardButton(config.get("BACK"), callback_data="back")]]
+    keyboard.extend(
+        [
+            InlineKeyboardButton(
+                challenge.question,
+                callback_data=f"detail_question_private|{challenge.id}",
+            )
+        ]
+        for challenge in challenges
+    )
+    nav = list()
+    if page > 0:
+        nav.append(
+            InlineKeyboardButton(
+                config.get("PREV_PAGE_BTN"),
+                callback_data=f"list_question_private|{page - 1}",
+            )
+        )
+    if page < pages - 1:
+        nav.append(
+            InlineKeyboardButton(
+                config.get("NEXT_PAGE_BTN"),
+                callback_data=f"list_question_private|{page + 1}",
+            )
+        )
+    if nav:
+        keyboard.append(nav)
+    title = config.get("LIST_PRIVATE" if matches is None else "SEARCH_PRIVATE")
+    return (
+        title.format(text=text, total=total, page=page + 1, pages=pages),
+        InlineKeyboardMarkup(keyboard),
+    )
+
+
 def start_private(update: Update, context: CallbackContext) -> int:
     message = update.message
     callback_query = update.callback_query
@@ -416,29 +1002,16 @@ def start_private(update: Update, context: CallbackContext) -> int:
         user = callback_query.from_user
     else:
         user = message.from_user
-    if user.id not in get_chat_admins(
-        context.bot,
-        context.bot_data.get("config").get("CHAT"),
-        extra_user=context.bot_data.get("config").get("SUPER_ADMIN"),
-    ):
-        logger.info(f"Private: User {user.id} is unauthorized, blocking")
-        message.reply_text(
-            context.bot_data.get("config").get("START_UNAUTHORIZED_PRIVATE")
-        )
-        return ConversationHandler.END
+    chats = managed_chats(context, user.id)
+    if not chats:
+        return unauthorized(update, context)
+    if callback_query and callback_query.data.startswith("chat_private|"):
+        context.user_data.update(chat=int(callback_query.data.split("|")[1]))
+    if context.user_data.get("chat") not in chats:
+        context.user_data.update(chat=chats[0])
+    context.user_data.pop("search", None)
+    context.user_data.pop("page", None)
     keyboard = [
-        [
-            InlineKeyboardButton(
-                context.bot_data.get("config").get("SAVE_QUESTION_BTN"),
-                callback_data="save",
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                context.bot_data.get("config").get("ADD_NEW_QUESTION_BTN"),
-                callback_data=f'edit_question_private|{len(context.bot_data.get("config").get("CHALLENGE"))}',
-            )
-        ],
         [
             InlineKeyboardButton(
                 context.bot_data.get("config").get("LIST_ALL_QUESTION_BTN"),
@@ -446,25 +1019,49 @@ def start_private(update: Update, context: CallbackContext) -> int:
             )
         ],
     ]
+    if may_edit_bank(context, user.id):
+        keyboard[:0] = [
+            [
+                InlineKeyboardButton(
+                    context.bot_data.get("config").get("SAVE_QUESTION_BTN"),
+                    callback_data="save",
+                )
+            ],
+            [
+                InlineKeyboardButton(
+                    context.bot_data.get("config").get("ADD_NEW_QUESTION_BTN"),
+                    callback_data=f"edit_question_private|{NEW_QUESTION}",
+                )
+            ],
+        ]
+    if len(chats) > 1:
+        keyboard.append(
+            [
+                InlineKeyboardButton(
+                    context.bot_data.get("config").get("CHAT_BTN").format(chat=chat_id),
+                    callback_data=f"chat_private|{chat_id}",
+                )
+                for chat_id in chats
+                if chat_id != context.user_data.get("chat")
+            ]
+        )
     markup = InlineKeyboardMarkup(keyboard)
     if callback_query:
         callback_query.edit_message_text(
             context.bot_data.get("config")
             .get("START_PRIVATE")
-            .format(link=context.bot_data.get("config").get("CHAT")),
+            .format(link=context.user_data.get("chat")),
             reply_markup=markup,
         )
     else:
         message.reply_text(
             context.bot_data.get("config")
             .get("START_PRIVATE")
-            .format(link=context.bot_data.get("config").get("CHAT")),
+            .format(link=context.user_data.get("chat")),
             reply_markup=markup,
         )
     logger.info("Private: Start")
-    logger.info(
-        f"Current Jobs: {[t.id for t in context.job_queue.scheduler.get_jobs()]}"
-    )
+    logger.info(status(context))
     logger.debug(callback_query)
     return CHOOSING
 
@@ -472,27 +1069,10 @@ def start_private(update: Update, context: CallbackContext) -> int:
 def list_question_private(update: Update, context: CallbackContext) -> int:
     callback_query = update.callback_query
     callback_query.answer()
-    logger.debug(context.bot_data.get("config").get("CHALLENGE"))
-    keyboard = [
-        [
-            InlineKeyboardButton(
-                flag.get("QUESTION"), callback_data=f"detail_question_private|{num}"
-            )
-        ]
-        for (num, flag) in enumerate(context.bot_data.get("config").get("CHALLENGE"))
-    ]
-    keyboard.insert(
-        0,
-        [
-            InlineKeyboardButton(
-                context.bot_data.get("config").get("BACK"), callback_data="back"
-            )
-        ],
-    )
-    markup = InlineKeyboardMarkup(keyboard)
-    callback_query.edit_message_text(
-        context.bot_data.get("config").get("LIST_PRIVATE"), reply_markup=markup
-    )
+    if callback_query.data.startswith("list_question_private|"):
+        context.user_data.update(page=private_callback(callback_query.data))
+    text, markup = question_page(context)
+    callback_query.edit_message_text(text, reply_markup=markup)
     logger.info("Private: List question")
     logger.debug(callback_query)
     return LIST_VIEW
@@ -501,35 +1081,45 @@ def list_question_private(update: Update, context: CallbackContext) -> int:
 def detail_question_private(update: Update, context: CallbackContext) -> int:
     callback_query = update.callback_query
     callback_query.answer()
-    num = private_callback(callback_query.data)
+    question = private_callback(callback_query.data)
+    bank = chat_bank(context)
+    # A store keeps deleted rows for the buttons already sent, only the live
+    # ones have a position.
+    if bank.position(question) is None or not (challenge := bank.get(question)):
+        # Deleted since the list was sent, show the list again.
+        text, markup = question_page(context)
+        callback_query.edit_message_text(text, reply_markup=markup)
+        return LIST_VIEW
     keyboard = [
         [
             InlineKeyboardButton(
                 context.bot_data.get("config").get("BACK"), callback_data="back"
             )
         ],
-        [
-            InlineKeyboardButton(
-                context.bot_data.get("config").get("EDIT_QUESTION_BTN"),
-                callback_data=f"edit_question_private|{num}",
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                context.bot_data.get("config").get("DELETE_QUESTION_BTN"),
-                callback_data=f"delete_question_private|{num}",
-            )
-        ],
     ]
+    if may_edit_bank(context, callback_query.from_user.id):
+        keyboard += [
+            [
+                InlineKeyboardButton(
+                    context.bot_data.get("config").get("EDIT_QUESTION_BTN"),
+                    callback_data=f"edit_question_private|{question}",
+                )
+            ],
+            [
+                InlineKeyboardButton(
+                    context.bot_data.get("config").get("DELETE_QUESTION_BTN"),
+                    callback_data=f"delete_question_private|{question}",
+                )
+            ],
+        ]
     markup = InlineKeyboardMarkup(keyboard)
-    flag = context.bot_data.get("config").get("CHALLENGE")[num]
     callback_query.edit_message_text(
         context.bot_data.get("config")
         .get("DETAIL_QUESTION_PRIVATE")
         .format(
-            question=flag.get("QUESTION"),
-            ans=flag.get("ANSWER"),
-            wrong="\n".join(flag.get("WRONG")),
+            question=challenge.question,
+            ans=challenge.answer,
+            wrong="\n".join(challenge.wrong),
         ),
         reply_markup=markup,
     )
@@ -538,9 +1128,10 @@ def detail_question_private(update: Update, context: CallbackContext) -> int:
     return DETAIL_VIEW
 
 
-def save_private(context: CallbackContext, callback_query: CallbackQuery) -> None:
+def save_private(
+    context: CallbackContext, callback_query: CallbackQuery, bank=None
+) -> None:
     if context.bot_data.get("config"):
-        save_config(context.bot_data["config"], filename)
         context.chat_data.clear()
         keyboard = [
             [
@@ -550,24 +1141,43 @@ def save_private(context: CallbackContext, callback_query: CallbackQuery) -> Non
             ],
         ]
         markup = InlineKeyboardMarkup(keyboard)
-        callback_query.edit_message_text(
-            reload_config(context),
-            reply_markup=markup,
-        )
-        logger.info(f"Private: Saved config")
-        logger.debug(context.bot_data.get("config"))
+
+        def reply(text: str) -> None:
+            callback_query.edit_message_text(text, reply_markup=markup)
+
+        if bank is not None and bank.persistent:
+            # The store already holds the edit, only the other workers reload.
+            reply(reload_config(context))
+            logger.info(f"Private: Saved question store")
+            return
+        save_and_reload(context, context.bot_data.get("config"), reply)
+        logger.info(f"Private: Saving config")
+
+
+def save_and_reload(
+    context: CallbackContext, config: dict, reply: Callable[[str], object]
+) -> None:
+    def callback(future: Future) -> None:
+        if err := future.exception():
+            reply(context.bot_data.get("config").get("CORRUPT").format(text=str(err)))
+        else:
+            reply(reload_config(context))
+
+    save_config(config, filename).add_done_callback(callback)
 
 
 def delete_question_private(update: Update, context: CallbackContext) -> int:
     callback_query = update.callback_query
     callback_query.answer()
+    if not may_edit_bank(context, callback_query.from_user.id):
+        return unauthorized(update, context)
     callback_query.edit_message_text(
         context.bot_data.get("config").get("DELETING_PRIVATE")
     )
-    num = private_callback(callback_query.data)
-    tile = context.bot_data.get("config").get("CHALLENGE").pop(num)
+    bank = chat_bank(context)
+    tile = bank.delete(private_callback(callback_query.data))
     logger.info(f"Private: Delete question {tile}")
-    save_private(context, callback_query)
+    save_private(context, callback_query, bank)
     return DETAIL_VIEW
 
 
@@ -577,13 +1187,15 @@ def edit_question_private(update: Update, context: CallbackContext) -> int:
     if callback_query:
         text = "Begin"
         callback_query.answer()
+        if not may_edit_bank(context, callback_query.from_user.id):
+            return unauthorized(update, context)
         index = private_callback(callback_query.data)
         context.chat_data.clear()
         context.chat_data.update(index=index)
         callback_query.edit_message_text(
             context.bot_data.get("config")
             .get("EDIT_QUESTION_PRIVATE")
-            .format(num=index + 1)
+            .format(num=question_number(context, index))
         )
     elif message:
         text = message.text
@@ -643,7 +1255,7 @@ def finish_edit_private(update: Update, context: CallbackContext) -> int:
             [
                 context.bot_data.get("config")
                 .get("EDIT_FINISH_PRIVATE")
-                .format(num=index + 1),
+                .format(num=question_number(context, index)),
                 context.bot_data.get("config")
                 .get("DETAIL_QUESTION_PRIVATE")
                 .format(
@@ -662,28 +1274,45 @@ def finish_edit_private(update: Update, context: CallbackContext) -> int:
 def save_question_private(update: Update, context: CallbackContext) -> int:
     callback_query = update.callback_query
     callback_query.answer()
+    if not may_edit_bank(context, callback_query.from_user.id):
+        return unauthorized(update, context)
     callback_query.edit_message_text(
         context.bot_data.get("config").get("SAVING_PRIVATE")
     )
+    bank = None
     if context.chat_data:
+        bank = chat_bank(context)
         index = (
             context.chat_data.pop("index")
             if "index" in context.chat_data
-            else len(context.bot_data.get("config").get("CHALLENGE"))
+            else NEW_QUESTION
         )
-        if index < len(context.bot_data.get("config").get("CHALLENGE")):
-            context.bot_data.get("config").get("CHALLENGE")[
-                index
-            ] = context.chat_data.copy()
-        else:
-            context.bot_data.get("config").get("CHALLENGE").append(
-                context.chat_data.copy()
+        try:
+            bank.put(index, context.chat_data.copy())
+        except AssertionError as err:
+            callback_query.edit_message_text(
+                context.bot_data.get("config").get("CORRUPT").format(text=str(err))
             )
+            return DETAIL_VIEW
         logger.info(f"Private: Saving question {context.chat_data}")
-    save_private(context, callback_query)
+    save_private(context, callback_query, bank)
     return DETAIL_VIEW
 
 
+def search_private(update: Update, context: CallbackContext) -> int:
+    message = update.message
+    text = " ".join(context.args)
+    if text:
+        context.user_data.update(search=text)
+    else:
+        context.user_data.pop("search", None)
+    context.user_data.update(page=0)
+    title, markup = question_page(context)
+    message.reply_text(title, reply_markup=markup)
+    logger.info(f"Private: Search question {text}")
+    return LIST_VIEW
+
+
 def cancel_private(update: Update, context: CallbackContext) -> int:
     message = update.message
     context.chat_data.clear()
@@ -694,6 +1323,9 @@ def cancel_private(update: Update, context: CallbackContext) -> int:
 
 def config_private(update: Update, context: CallbackContext) -> int:
     message = update.message
+    # The file holds TOKEN and the settings of every chat.
+    if not global_admin(context, message.from_user.id):
+        return unauthorized(update, context)
     with open(filename, "rb") as file:
         message.reply_document(file)
     logger.info(f"Private: Config")
@@ -702,73 +1334,103 @@ def config_private(update: Update, context: CallbackContext) -> int:
 
 def config_file_private(update: Update, context: CallbackContext) -> None:
     message = update.effective_message
-    file_id = message.document.file_id
-    filestream = updater.bot.get_file(file_id)
-    if filestream:
-        file = BytesIO()
-        filestream.download(out=file)
-        logger.info(f"Private: Config file successfully downloaded {file_id}")
+    document = message.document
+    config = context.bot_data.get("config")
+    # An upload replaces the settings of every chat.
+    if not global_admin(context, message.from_user.id):
+        unauthorized(update, context)
+        return
+    limit = config.get("UPLOAD_LIMIT")
+    if document.file_size and document.file_size > limit:
+        message.reply_text(
+            config.get("CORRUPT").format(
+                text=f"Config: File is larger than {limit} bytes."
+            )
+        )
+        return
+    # Staged next to the live file, so swapping it in is an atomic rename.
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(filename)) as directory:
+        source = os.path.join(directory, "upload.yml")
+        staged = os.path.join(directory, os.path.basename(filename))
         try:
-            with file:
-                config = load_config(yaml.load(file.getvalue()), check_token=False)
-            save_config(config, filename)
-            message.reply_text(reload_config(context))
+            download(
+                updater.bot.request,
+                updater.bot.get_file(document.file_id).file_path,
+                source,
+                limit,
+                config.get("UPLOAD_TIMEOUT"),
+            )
         except Exception as err:
-            logger.error(err)
-            message.reply_text(
-                context.bot_data.get("config").get("CORRUPT").format(text=err.__str__())
+            errors = [str(err)]
+        else:
+            logger.info(
+                f"Private: Config file successfully downloaded {document.file_id}"
+            )
+            errors = check_upload(
+                source, staged, updater.bot.token, config.get("UPLOAD_TIMEOUT")
             )
+        if errors:
+            logger.error(f"Private: Rejected config file {document.file_id}: {errors}")
+            message.reply_text(config.get("CORRUPT").format(text=join_errors(errors)))
+            return
+        # A save still queued would overwrite the upload after the swap.
+        writer.flush()
+        swap(staged, filename)
+    message.reply_text(reload_config(context))
 
 
-def reload_config(context: CallbackContext) -> str:
-    for job in context.job_queue.get_jobs_by_name("reload"):
-        job.schedule_removal()
-    if jobs := [t.id for t in context.job_queue.scheduler.get_jobs()]:
-        context.job_queue.scheduler.add_job(
-            reload_config,
-            "date",
-            name="reload",
-            run_date=context.job_queue._tz_now()
-            + datetime.timedelta(seconds=context.bot_data.get("config").get("TIME")),
-            replace_existing=True,
-        )
-        logger.info(f"Job reload: Waiting for {jobs}")
-        return context.bot_data.get("config").get("PENDING")
-    else:
-        try:
-            with open(filename, "r", encoding="utf-8") as file:
-                context.bot_data.update(
-                    config=load_config(yaml.load(file), check_token=False)
-                )
-            logger.info(f"Job reload: Successfully reloaded {filename}")
-            return (
-                context.bot_data.get("config")
-                .get("RELOAD")
-                .format(num=len(context.bot_data.get("config").get("CHALLENGE")))
-            )
-        except Exception as err:
-            logger.error(err)
-            return (
-                context.bot_data.get("config").get("CORRUPT").format(text=err.__str__())
+def reload_config(context: CallbackContext, broadcast: bool = True) -> str:
+    try:
+        config, _ = load_config_file(filename, check_token=False)
+    except Exception as err:
+        logger.error(err)
+        return context.bot_data.get("config").get("CORRUPT").format(text=err.__str__())
+    # New joins pick the new snapshot, pending challenges keep theirs.
+    with context.bot_data.get("lock"):
+        context.bot_data.get("snapshots")[config.get("version")] = config
+        context.bot_data.update(config=config)
+    collect_snapshots(context)
+    if broadcast and (cluster := context.bot_data.get("cluster")):
+        cluster.broadcast(RELOAD)
+    logger.info(
+        f"Job reload: Successfully reloaded {filename} as version {config.get('version')}"
+    )
+    return config.get("RELOAD").format(num=len(config.get("bank")))
+
+
+def collect_snapshots(context: CallbackContext) -> None:
+    live = set()
+    for shard in context.bot_data.get("shards"):
+        with shard.lock:
+            live.update(
+                challenge.get("version") for challenge in shard.challenges.values()
             )
+    with context.bot_data.get("lock"):
+        live.add(context.bot_data.get("config").get("version"))
+        for version in set(context.bot_data.get("snapshots")) - live:
+            context.bot_data.get("snapshots").pop(version)
+            logger.info(f"Config: Released snapshot {version}")
+
+
+def start_ingress(updater: Updater, config: dict) -> Optional[Ingress]:
+    if (DOMAIN := os.environ.get("DOMAIN")) and (TOKEN := config.get("TOKEN")):
+        start_dispatcher(updater)
+        ingress = Ingress(
+            updater,
+            f"/{TOKEN}",
+            port=int(os.environ.get("PORT", 8080)),
+            size=config.get("INGRESS_QUEUE"),
+            max_age=config.get("INGRESS_MAX_AGE"),
+            policy=config.get("INGRESS_POLICY"),
+        )
+        ingress.start(webhook_url=DOMAIN + TOKEN)
+        return ingress
+    updater.start_polling()
+    return None
 
 
-def save_config(config: dict, name: Optional[str] = None) -> None:
-    save = copy.deepcopy(config)
-    if not name:
-        name = f"{filename}.bak"
-    for flag in save.get("CHALLENGE"):
-        if flag.get("answer"):
-            flag.pop("answer")
-        if flag.get("wrong"):
-            flag.pop("wrong")
-        if flag.get("index"):
-            flag.pop("index")
-    save["TOKEN"] = updater.bot.token
-    with open(name, "w") as file:
-        yaml.dump(save, file)
-    logger.info(f"Config: Dumped {name}")
-    logger.debug(save)
+def save_config(config: dict, name: Optional[str] = None) -> Future:
+    return writer.save(config, name or f"{filename}.bak", updater.bot.token)
 
 
 if __name__ == "__main__":
@@ -790,94 +1452,180 @@ if __name__ == "__main__":
         action="store_true",
         help="enable logging to file",
     )
+    parser.add_argument(
+        "-j",
+        "--json",
+        action="store_true",
+        help="log to stream as JSON events, the file log always is",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        default=1,
+        help="worker processes, updates are routed to them by chat ID, defaults to 1",
+        type=int,
+    )
     args = parser.parse_args()
     filename = os.path.abspath(args.file)
     if not os.path.exists(filename):
         parser.error(f"The file {filename} does not exist!")
-    log_to_stream()
+    log_to_stream(args.json)
     if args.debug:
         log_to_file(f"{filename}.log")
-    with open(filename, "r", encoding="utf-8") as file:
-        config = load_config(yaml.load(file))
-    logger.info(f"Yaml: Loaded {filename}")
+    start_logging()
+    start = time.perf_counter()
+    config, cached = load_config_file(filename)
+    logger.info(
+        f"Yaml: Loaded {filename} in {(time.perf_counter() - start) * 1000:.1f}ms"
+        f"{' from cached snapshot' if cached else ''}"
+    )
+    # Fork before any thread starts, the front only receives and routes updates.
+    cluster = Cluster(args.processes) if args.processes > 1 else None
+    if cluster:
+        # The listener thread does not survive fork, every process runs its own.
+        stop_logging()
+        cluster.fork()
+        start_logging()
+    if cluster and cluster.index is None:
+        # The front's dispatcher runs PTB's 4 default workers and only routes.
+        updater = Updater(
+            bot=ExtBot(config.get("TOKEN"), request=build_request(config, 4 + 4))
+        )
+        updater.dispatcher.add_handler(TypeHandler(Update, cluster.route))
+        ingress = start_ingress(updater, config)
+        logger.info(f"Cluster: Routing updates to {cluster.processes} workers")
+        updater.idle()
+        if ingress:
+            ingress.stop()
+        cluster.stop()
+        stop_logging()
+        sys.exit()
     command = list()
-    updater = Updater(config.get("TOKEN"))
-    save_config(config)
-    updater.dispatcher.bot_data.update(config=config)
+    # Every handler runs on the dispatcher's worker pool, so a blocking Bot API
+    # call only holds its own worker. WORKERS caps the in-flight updates.
+    updater = Updater(
+        bot=ExtBot(
+            config.get("TOKEN"),
+            defaults=Defaults(run_async=True),
+            request=build_request(config),
+        ),
+        workers=config.get("WORKERS"),
+    )
+    updater.job_queue.scheduler.configure(
+        executors={"default": ThreadPoolExecutor(config.get("WORKERS"))}
+    )
+    # Resolved once here, handlers read the cached identity through bot.id.
+    bot_me = updater.bot.get_me()
+    writer = ConfigWriter()
+    if not cached and not (cluster and cluster.index):
+        save_config(config)
+    outbox = Outbox(
+        workers=config.get("WORKERS"),
+        # The global limit is per bot, workers split it evenly.
+        rate=config.get("GLOBAL_RATE") / args.processes,
+        chat_rate=config.get("CHAT_RATE") / 60,
+        chat_burst=config.get("CHAT_RATE"),
+    )
+    cleaner = Cleaner(updater.bot, outbox, delay=config.get("CLEAN_DELAY"))
+    store = ChallengeStore(config.get("STORE") or f"{filename}.db")
+    wheel = TimerWheel(
+        lambda expired: updater.dispatcher.run_async(
+            expire, CallbackContext(updater.dispatcher), expired
+        )
+    )
+    updater.dispatcher.bot_data.update(
+        config=config,
+        snapshots={config.get("version"): config},
+        secret=derive_key(config.get("SECRET") or updater.bot.token),
+        lock=threading.Lock(),
+        shards=Shards(),
+        wheel=wheel,
+        store=store,
+        outbox=outbox,
+        cleaner=cleaner,
+        cluster=cluster,
+    )
     updater.dispatcher.add_handler(
         CommandHandler("start", start_command, filters=Filters.chat_type.groups)
     )
-    chatfilter = Filters.chat(config.get("CHAT")) if config.get("CHAT") else None
+    chatfilter = Filters.chat(chat_ids(config)) if chat_ids(config) else None
     updater.dispatcher.add_handler(
         MessageHandler(
             MergedFilter(Filters.status_update.new_chat_members, and_filter=chatfilter),
             newmem,
-            run_async=True,
         )
     )
-    updater.dispatcher.add_handler(CallbackQueryHandler(query, pattern=r"^challenge\|"))
+    updater.dispatcher.add_handler(CallbackQueryHandler(query, pattern=r"^c\|"))
     updater.dispatcher.add_handler(CallbackQueryHandler(admin, pattern=r"^admin\|"))
-    if config.get("CHAT"):
+    reachable = list()
+    for chat_id in chat_ids(config):
         try:
-            updater.bot.get_chat_administrators(config.get("CHAT"))
+            updater.bot.get_chat_administrators(chat_id)
         except BadRequest as err:
-            logger.error(err)
+            logger.error(f"Config: Group {chat_id} is unreachable: {err}")
         else:
-            CHOOSING, LIST_VIEW, DETAIL_VIEW, QUESTION_EDIT = range(4)
-            conv_handler = ConversationHandler(
-                entry_points=[
-                    CommandHandler(
-                        "start", start_private, filters=Filters.chat_type.private
-                    )
+            reachable.append(chat_id)
+    if reachable:
+        CHOOSING, LIST_VIEW, DETAIL_VIEW, QUESTION_EDIT = range(4)
+        conv_handler = ConversationHandler(
+            entry_points=[
+                CommandHandler(
+                    "start", start_private, filters=Filters.chat_type.private
+                )
+            ],
+            states={
+                CHOOSING: [
+                    CallbackQueryHandler(start_private, pattern=r"^chat_private\|"),
+                    CallbackQueryHandler(save_question_private, pattern=r"^save$"),
+                    CallbackQueryHandler(
+                        edit_question_private, pattern=r"^edit_question_private"
+                    ),
+                    CallbackQueryHandler(
+                        list_question_private, pattern=r"^list_question_private"
+                    ),
                 ],
-                states={
-                    CHOOSING: [
-                        CallbackQueryHandler(save_question_private, pattern=r"^save$"),
-                        CallbackQueryHandler(
-                            edit_question_private, pattern=r"^edit_question_private"
-                        ),
-                        CallbackQueryHandler(
-                            list_question_private, pattern=r"^list_question_private"
-                        ),
-                    ],
-                    LIST_VIEW: [
-                        CallbackQueryHandler(start_private, pattern=r"^back$"),
-                        CallbackQueryHandler(
-                            detail_question_private, pattern=r"^detail_question_private"
-                        ),
-                    ],
-                    DETAIL_VIEW: [
-                        CallbackQueryHandler(save_question_private, pattern=r"^save$"),
-                        CallbackQueryHandler(list_question_private, pattern=r"^back$"),
-                        CallbackQueryHandler(
-                            delete_question_private, pattern=r"^delete_question_private"
-                        ),
-                        CallbackQueryHandler(
-                            edit_question_private, pattern=r"^edit_question_private"
-                        ),
-                    ],
-                    QUESTION_EDIT: [
-                        MessageHandler(
-                            Filters.text & ~Filters.command, edit_question_private
-                        ),
-                        CommandHandler("finish", finish_edit_private),
-                    ],
-                },
-                fallbacks=[
-                    CommandHandler("cancel", cancel_private),
-                    CommandHandler("config", config_private),
-                    CommandHandler("reload", reload_private),
+                LIST_VIEW: [
+                    CallbackQueryHandler(start_private, pattern=r"^back$"),
+                    CallbackQueryHandler(
+                        list_question_private, pattern=r"^list_question_private\|"
+                    ),
+                    CallbackQueryHandler(
+                        detail_question_private, pattern=r"^detail_question_private"
+                    ),
+                ],
+                DETAIL_VIEW: [
+                    CallbackQueryHandler(save_question_private, pattern=r"^save$"),
+                    CallbackQueryHandler(list_question_private, pattern=r"^back$"),
+                    CallbackQueryHandler(
+                        delete_question_private, pattern=r"^delete_question_private"
+                    ),
+                    CallbackQueryHandler(
+                        edit_question_private, pattern=r"^edit_question_private"
+                    ),
+                ],
+                QUESTION_EDIT: [
                     MessageHandler(
-                        Filters.document,
-                        config_file_private,
+                        Filters.text & ~Filters.command, edit_question_private
                     ),
+                    CommandHandler("finish", finish_edit_private),
                 ],
-                name="setting",
-                allow_reentry=True,
-                # persistent=True,
-            )
-            updater.dispatcher.add_handler(conv_handler)
-            logger.info("Enhanced admin control enabled for private chat.")
+            },
+            fallbacks=[
+                CommandHandler("cancel", cancel_private),
+                CommandHandler("config", config_private),
+                CommandHandler("reload", reload_private),
+                CommandHandler("search", search_private),
+                MessageHandler(
+                    Filters.document,
+                    config_file_private,
+                ),
+            ],
+            name="setting",
+            allow_reentry=True,
+            # persistent=True,
+        )
+        updater.dispatcher.add_handler(conv_handler)
+        logger.info("Enhanced admin control enabled for private chat.")
     if config.get("QUIZ"):
         updater.dispatcher.add_handler(
             CommandHandler("quiz", quiz_command, filters=chatfilter)
@@ -890,16 +1638,52 @@ if __name__ == "__main__":
         )
         command.append(["admin", config.get("ADMIN")])
         logger.info("Admin command registered.")
-    if (DOMAIN := os.environ.get("DOMAIN")) and (TOKEN := config.get("TOKEN")):
-        updater.start_webhook(
-            listen="0.0.0.0",
-            port=int(os.environ.get("PORT", 8080)),
-            url_path=TOKEN,
-            webhook_url=DOMAIN + TOKEN,
+    ingress = None
+    if cluster:
+        cluster.serve(
+            updater,
+            lambda: reload_config(CallbackContext(updater.dispatcher), broadcast=False),
         )
     else:
-        updater.start_polling()
-    bot_me = updater.bot.get_me()
+        ingress = start_ingress(updater, config)
+    updater.dispatcher.bot_data.update(ingress=ingress)
+    Gauge(
+        "easyauth_pending_challenges", "Challenges up to their deadline", wheel.__len__
+    )
+    Gauge("easyauth_outbox_depth", "Bot API calls waiting to be sent", outbox.__len__)
+    Gauge(
+        "easyauth_admin_cache_hit_ratio",
+        "Hit ratio of the chat admin cache",
+        lambda: get_chat_admins_record.cache.stats().get("ratio"),
+    )
+    Gauge(
+        "easyauth_http_pool_size",
+        "Bot API connections kept in the pool",
+        lambda: updater.bot.request.stats().get("size"),
+    )
+    Gauge(
+        "easyauth_http_pool_in_use",
+        "Bot API connections checked out of the pool",
+        lambda: updater.bot.request.stats().get("in_use"),
+    )
+    if ingress:
+        Gauge(
+            "easyauth_ingress_depth",
+            "Updates waiting in the webhook queue",
+            lambda: ingress.stats().get("depth"),
+        )
+        Gauge(
+            "easyauth_ingress_age_seconds",
+            "Age of the oldest update in the webhook queue",
+            lambda: ingress.stats().get("age"),
+        )
+    metrics = None
+    if config.get("METRICS_PORT"):
+        # Every cluster worker serves its own registry on the next port.
+        metrics = MetricsServer(
+            config.get("METRICS_PORT") + (cluster.index if cluster else 0)
+        )
+        metrics.start()
     rights = ChatAdministratorRights.no_rights()
     rights.can_manage_chat=True
     rights.can_delete_messages=True
@@ -912,4 +1696,21 @@ if __name__ == "__main__":
         logger.warning(f"Bot's [Group privacy] could be enabled.")
     updater.bot.set_my_commands(command)
     logger.info(f"Bot @{bot_me.username} started.")
+    replay(CallbackContext(updater.dispatcher))
+    wheel.start()
+    # kill -USR1 dumps the live config to the log without restarting.
+    signal.signal(
+        signal.SIGUSR1,
+        lambda signum, frame: dump_config(updater.dispatcher.bot_data.get("config")),
+    )
     updater.idle()
+    if ingress:
+        ingress.stop()
+    if metrics:
+        metrics.stop()
+    wheel.stop()
+    cleaner.flush()
+    outbox.stop()
+    writer.flush()
+    store.close()
+    stop_logging()
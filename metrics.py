@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+
+from telegram.ext import CallbackContext
+from telegram.utils.request import Request
+
+from utils import get_chat_admins_record, logger
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+WAIT_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels)
+        + "}"
+    )
+
+
+class Metric(object):
+    """Base of the Prometheus metric types, one series per label set"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._series: dict = dict()
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def samples(self) -> List[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{render_labels(labels)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def samples(self) -> list:
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._series.items()]
+
+
+class Gauge(Metric):
+    """Gauge read from func when scraped"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, func: Callable[[], float]):
+        super().__init__(name, help)
+        self.func = func
+
+    def samples(self) -> list:
+        try:
+            return [(self.name, (), float(self.func()))]
+        except Exception as err:
+            logger.warning(f"Metrics: Failed to read {self.name}: {err}")
+            return list()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if (series := self._series.get(key)) is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def timer(self, **labels) -> Callable:
+        """Decorate a function to observe its run time"""
+
+        def decorator(f: Callable) -> Callable:
+            @wraps(f)
+            def func(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, **labels)
+
+            return func
+
+        return decorator
+
+    def samples(self) -> list:
+        samples = list()
+        with self._lock:
+            series = [
+                (key, list(counts), total)
+                for key, (counts, total) in self._series.items()
+            ]
+        for key, counts, total in series:
+            count = 0
+            for bound, hits in zip((*self.buckets, "+Inf"), counts):
+                count += hits
+                samples.append(
+                    (f"{self.name}_bucket", (*key, ("le", str(bound))), count)
+                )
+            samples.append((f"{self.name}_sum", key, total))
+            samples.append((f"{self.name}_count", key, count))
+        return samples
+
+
+REGISTRY: List[Metric] = list()
+
+API_LATENCY = Histogram(
+    "easyauth_api_request_seconds", "Bot API request latency by method"
+)
+API_ERRORS = Counter("easyauth_api_errors_total", "Failed Bot API requests by method")
+HANDLER_LATENCY = Histogram(
+    "easyauth_handler_seconds", "Update handler latency by handler"
+)
+SCHEDULER_LAG = Histogram(
+    "easyauth_scheduler_lag_seconds",
+    "Delay between a challenge deadline and its expiration",
+)
+VERIFICATIONS = Counter("easyauth_verifications_total", "Resolved members by result")
+HTTP_POOL_WAIT = Histogram(
+    "easyauth_http_pool_wait_seconds",
+    "Time Bot API calls waited for a pooled connection",
+    WAIT_BUCKETS,
+)
+HTTP_POOL_EXHAUSTED = Counter(
+    "easyauth_http_pool_exhausted_total",
+    "Bot API calls that found no free connection within HTTP_POOL_TIMEOUT",
+)
+HTTP_CONNECTIONS = Counter(
+    "easyauth_http_connections_total", "Connections opened to the Bot API"
+)
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+def status(context: CallbackContext) -> str:
+    """Jobs, queues and caches of the bot in one line, logged on /start"""
+    ingress = context.bot_data.get("ingress")
+    return (
+        f"Current Jobs: {[t.id for t in context.job_queue.scheduler.get_jobs()]}, "
+        f"Pending challenges: {len(context.bot_data.get('wheel'))} "
+        f"in {len(context.bot_data.get('shards'))} chats, "
+        f"Admin cache: {get_chat_admins_record.cache.stats()}, "
+        f"HTTP pool: {context.bot.request.stats()}"
+        + (f", Ingress: {ingress.stats()}" if ingress else "")
+    )
+
+
+class TimedRequest(Request):
+    """Request recording the latency of every Bot API method"""
+
+    def post(self, url: str, data: Dict, timeout: float = None):
+        method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            return super().post(url, data, timeout=timeout)
+        except Exception:
+            API_ERRORS.inc(method=method)
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - start, method=method)
+
+
+class MetricsServer(object):
+    """Serve the registry as Prometheus text on /metrics"""
+
+    def __init__(self, port: int):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        self._server.daemon_threads = True
+
+    def start(self) -> None:
+        threading.Thread(
+            target=self._server.serve_forever, name="Metrics", daemon=True
+        ).start()
+        logger.info(f"Metrics: Serving /metrics on port {self._server.server_port}")
+
+    def stop(self) -> None:
+        self._server.shutdown()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from telegram.bot import Bot
+from telegram.error import BadRequest, InvalidToken, RetryAfter
+
+from utils import logger
+
+# Priority classes, lower goes first.
+RESTRICT, ANSWER, GREET, DELETE = range(4)
+
+
+class TokenBucket(object):
+    """Token bucket refilled at rate tokens per second up to burst"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available, 0 if one is available now"""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if now < self.until:
+            return self.until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        self.until = max(self.until, time.monotonic() + seconds)
+
+
+class Outbox(object):
+    """Priority outbox for Bot API calls with global and per-chat token buckets"""
+
+    def __init__(
+        self,
+        workers: int = 8,
+        rate: float = 30,
+        chat_rate: float = 20 / 60,
+        chat_burst: float = 20,
+    ):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        # One deque per chat and priority, chats are served round robin so a
+        # flooded chat only ever delays its own calls.
+        self._queues: List[OrderedDict] = [OrderedDict() for _ in range(DELETE + 1)]
+        self._global = TokenBucket(rate, rate)
+        self._chats: dict = dict()
+        self._cond = threading.Condition()
+        self._stop = False
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="Outbox")
+        self._thread = threading.Thread(
+            target=self._run, name="Outbox", daemon=True
+        )
+        self._thread.start()
+
+    def __len__(self) -> int:
+        return sum(len(items) for queue in self._queues for items in queue.values())
+
+    def submit(
+        self, priority: int, chat_id: Optional[int], func: Callable, /, *args, **kwargs
+    ) -> Future:
+        """Queue func, chat_id None only counts against the global bucket"""
+        future: Future = Future()
+        with self._cond:
+            self._queues[priority].setdefault(chat_id, deque()).append(
+                (priority, chat_id, func, args, kwargs, future)
+            )
+            self._cond.notify()
+        return future
+
+    def _bucket(self, chat_id: Optional[int]) -> TokenBucket:
+        if chat_id is None:
+            return self._global
+        if (bucket := self._chats.get(chat_id)) is None:
+            bucket = self._chats[chat_id] = TokenBucket(
+                self.chat_rate, self.chat_burst
+            )
+        return bucket
+
+    def _next(self) -> Tuple[Optional[tuple], float]:
+        now = time.monotonic()
+        if wait := self._global.delay(now):
+            return None, wait
+        wait = math.inf
+        for queue in self._queues:
+            for chat_id, items in queue.items():
+                if chat_id is None or not (delay := self._bucket(chat_id).delay(now)):
+                    item = items.popleft()
+                    if items:
+                        queue.move_to_end(chat_id)
+                    else:
+                        del queue[chat_id]
+                    self._global.take()
+                    if chat_id is not None:
+                        self._bucket(chat_id).take()
+                    return item, 0.0
+                wait = min(wait, delay)
+        return None, wait
+
+    def _run(self) -> None:
+        with self._cond:
+            while not self._stop:
+                item, wait = self._next()
+                if item is None:
+                    self._cond.wait(None if wait == math.inf else wait)
+                else:
+                    self._executor.submit(self._call, item)
+
+    def _call(self, item: tuple) -> None:
+        priority, chat_id, func, args, kwargs, future = item
+        try:
+            future.set_result(func(*args, **kwargs))
+        except RetryAfter as err:
+            logger.warning(
+                "Outbox: Flood control at %s, retry in %ss", chat_id, err.retry_after
+            )
+            with self._cond:
+                self._bucket(chat_id).pause(err.retry_after)
+                self._queues[priority].setdefault(chat_id, deque()).appendleft(item)
+                self._cond.notify()
+        except Exception as err:
+            logger.error("Outbox: %s failed: %s", getattr(func, "__name__", func), err)
+            future.set_exception(err)
+
+    def stop(self, timeout: float = 5) -> None:
+        """Drain queued calls for up to timeout seconds, then stop"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while len(self) and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+            self._stop = True
+            self._cond.notify()
+        self._executor.shutdown(wait=False)
+
+
+class Cleaner(object):
+    """Collect message deletions per chat and flush them with deleteMessages"""
+
+    def __init__(
+        self, bot: Bot, outbox: Outbox, delay: float = 1.0, size: int = 100
+    ):
+        self.bot = bot
+        self.outbox = outbox
+        self.delay = delay
+        self.size = min(size, 100)
+        self.bulk = True
+        self._pending: dict = dict()
+        self._lock = threading.Lock()
+
+    def add(self, chat_id: int, message_id: int) -> None:
+        with self._lock:
+            ids = self._pending.setdefault(chat_id, list())
+            ids.append(message_id)
+            if len(ids) >= self.size:
+                ids = self._pending.pop(chat_id)
+            elif len(ids) == 1:
+                timer = threading.Timer(self.delay, self.flush, args=(chat_id,))
+                timer.daemon = True
+                timer.start()
+                return
+            else:
+                return
+        self._submit(chat_id, ids)
+
+    def flush(self, chat_id: Optional[int] = None) -> None:
+        """Flush one chat, or every chat when chat_id is None"""
+        with self._lock:
+            if chat_id is None:
+                pending = list(self._pending.items())
+                self._pending.clear()
+            else:
+                pending = [(chat_id, self._pending.pop(chat_id, list()))]
+        for chat, ids in pending:
+            if ids:
+                self._submit(chat, ids)
+
+    def _submit(self, chat_id: int, ids: List[int]) -> None:
+        for t in range(0, len(ids), self.size):
+            self.outbox.submit(
+                DELETE, chat_id, self._delete, chat_id, ids[t : t + self.size]
+            )
+
+    def _delete(self, chat_id: int, ids: List[int]) -> None:
+        if self.bulk and len(ids) > 1:
+            try:
+                self.bot._post(
+                    "deleteMessages", dict(chat_id=chat_id, message_ids=ids)
+                )
+                logger.info(
+                    "Job clean: Successfully delete messages %s at group %s",
+                    ids,
+                    chat_id,
+                )
+                return
+            except InvalidToken:
+                # The Bot API answers 404 for unknown methods, use single deletes.
+                logger.warning("Job clean: deleteMessages is unavailable")
+                self.bulk = False
+            except BadRequest as err:
+                logger.warning(
+                    "Job clean: Bulk delete failed at group %s: %s", chat_id, err
+                )
+        for message_id in ids:
+            self.outbox.submit(
+                DELETE,
+                chat_id,
+                self.bot.delete_message,
+                chat_id=chat_id,
+                message_id=message_id,
+            )
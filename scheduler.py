@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import math
+import threading
+import time
+from typing import Any, Callable, Hashable, List, Optional, Tuple
+
+
+class TimerWheel(object):
+    """Hashed timing wheel, one entry per key, expirations fired per tick"""
+
+    def __init__(
+        self,
+        callback: Callable[[List[Tuple[Hashable, Any]]], None],
+        tick: float = 1.0,
+        slots: int = 512,
+    ):
+        self.callback = callback
+        self.tick = tick
+        self.slots = slots
+        self._wheel: List[dict] = [dict() for _ in range(slots)]
+        self._entries: dict = dict()
+        self._lock = threading.Lock()
+        self._cursor = int(time.time() / tick)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def _arm(self, key: Hashable, deadline: float, value: Any) -> None:
+        if (slot := self._entries.pop(key, None)) is not None:
+            self._wheel[slot].pop(key, None)
+        tick = max(math.ceil(deadline / self.tick), self._cursor + 1)
+        slot = tick % self.slots
+        self._wheel[slot][key] = (tick, value)
+        self._entries[key] = slot
+
+    def add(self, key: Hashable, deadline: float, value: Any = None) -> None:
+        """Arm or re-arm key to fire at the epoch deadline"""
+        with self._lock:
+            self._arm(key, deadline, value)
+
+    def add_many(self, entries: List[Tuple[Hashable, float]]) -> None:
+        """Arm many keys under a single lock acquisition"""
+        with self._lock:
+            for key, deadline in entries:
+                self._arm(key, deadline, None)
+
+    def cancel(self, key: Hashable) -> Any:
+        """Disarm key and return its value, None if it is not armed"""
+        with self._lock:
+            if (slot := self._entries.pop(key, None)) is None:
+                return None
+            return self._wheel[slot].pop(key)[1]
+
+    def advance(self, now: Optional[float] = None) -> List[Tuple[Hashable, Any]]:
+        """Collect every entry due up to now, the wheel thread calls this per tick"""
+        target = int((now or time.time()) / self.tick)
+        expired: list = list()
+        with self._lock:
+            while self._cursor < target:
+                self._cursor += 1
+                bucket = self._wheel[self._cursor % self.slots]
+                due = [key for key, (tick, _) in bucket.items() if tick <= self._cursor]
+                for key in due:
+                    expired.append((key, bucket.pop(key)[1]))
+                    self._entries.pop(key, None)
+        return expired
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.tick - time.time() % self.tick):
+            if expired := self.advance():
+                self.callback(expired)
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="TimerWheel", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Iterator, List, Optional
+
+
+class ChatShard(object):
+    """Join queue and pending challenges of one chat behind its own lock"""
+
+    __slots__ = ("chat_id", "lock", "joins", "challenges", "joined", "raid")
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.lock = threading.Lock()
+        self.joins: List[tuple] = list()
+        self.challenges: dict = dict()
+        # Join times inside the raid detection window.
+        self.joined: deque = deque()
+        # Resolves to the message ID of the raid challenge while in raid mode.
+        self.raid: Optional[Future] = None
+
+
+class Shards(object):
+    """Per-chat state, created on first use so chats never share a lock"""
+
+    def __init__(self):
+        self._shards: dict = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._shards)
+
+    def __iter__(self) -> Iterator[ChatShard]:
+        with self._lock:
+            return iter(list(self._shards.values()))
+
+    def get(self, chat_id: int) -> ChatShard:
+        if (shard := self._shards.get(chat_id)) is None:
+            with self._lock:
+                if (shard := self._shards.get(chat_id)) is None:
+                    shard = self._shards[chat_id] = ChatShard(chat_id)
+        return shard
@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import groupby
+from random import SystemRandom
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from utils import Challenge, check_question, compile_challenge, logger, yaml
+
+PENDING, PASSED, FAILED = range(3)
+# Seconds a connection waits for another process holding the write lock.
+BUSY_TIMEOUT = 10
+# Attempts of a batch of challenge writes before it is dropped.
+RETRIES = 3
+
+
+class ChallengeStore(object):
+    """SQLite (WAL) store of pending challenges with batched writes"""
+
+    def __init__(self, filename: str, interval: float = 0.2, batch: int = 512):
+        self.filename = filename
+        self.interval = interval
+        self.batch = batch
+        self._lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        self.db = sqlite3.connect(
+            filename,
+            timeout=BUSY_TIMEOUT,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS challenges ("
+            "chat_id INTEGER, message_id INTEGER, question INTEGER, text TEXT, "
+            "deadline REAL, raid INTEGER DEFAULT 0, PRIMARY KEY (chat_id, message_id))"
+        )
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(challenges)")]
+        if "raid" not in columns:
+            # Stores written before raids were persisted.
+            self.db.execute("ALTER TABLE challenges ADD COLUMN raid INTEGER DEFAULT 0")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS members ("
+            "chat_id INTEGER, message_id INTEGER, user_id INTEGER, join_id INTEGER, "
+            "name TEXT, state INTEGER, PRIMARY KEY (chat_id, message_id, user_id))"
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="ChallengeStore", daemon=True
+        )
+        self._thread.start()
+
+    def add(
+        self,
+        chat_id: int,
+        message_id: int,
+        question: int,
+        text: str,
+        deadline: float,
+        users: Iterable[Tuple[int, int, str]],
+        raid: bool = False,
+    ) -> None:
+        self._queue.put(
+            (
+                "INSERT OR REPLACE INTO challenges "
+                "(chat_id, message_id, question, text, deadline, raid) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (chat_id, message_id, question, text, deadline, int(raid)),
+            )
+        )
+        for user_id, join_id, name in users:
+            self._queue.put(
+                (
+                    "INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?, ?)",
+                    (chat_id, message_id, user_id, join_id, name, PENDING),
+                )
+            )
+
+    def resolve(self, chat_id: int, message_id: int, user_id: int, result: bool) -> None:
+        self._queue.put(
+            (
+                "UPDATE members SET state = ? "
+                "WHERE chat_id = ? AND message_id = ? AND user_id = ?",
+                (PASSED if result else FAILED, chat_id, message_id, user_id),
+            )
+        )
+
+    def remove(self, chat_id: int, message_id: int) -> None:
+        for table in ("challenges", "members"):
+            self._queue.put(
+                (
+                    f"DELETE FROM {table} WHERE chat_id = ? AND message_id = ?",
+                    (chat_id, message_id),
+                )
+            )
+
+    def load(self, shard: Optional[Tuple[int, int]] = None) -> List[dict]:
+        """Read stored challenges with their members grouped in
+
+        shard is (index, processes), only chats routed to that worker are read.
+        """
+        sql, params = (
+            "SELECT chat_id, message_id, question, text, deadline, raid "
+            "FROM challenges",
+            (),
+        )
+        if shard:
+            sql, params = f"{sql} WHERE abs(chat_id) % ? = ?", shard[::-1]
+        with self._lock:
+            challenges = {
+                (chat_id, message_id): dict(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    question=question,
+                    text=text,
+                    deadline=deadline,
+                    raid=bool(raid),
+                    users=dict(),
+                    clean=set(),
+                )
+                for chat_id, message_id, question, text, deadline, raid in (
+                    self.db.execute(sql, params)
+                )
+            }
+            members = self.db.execute("SELECT * FROM members").fetchall()
+        for chat_id, message_id, user_id, join_id, name, state in members:
+            if not (challenge := challenges.get((chat_id, message_id))):
+                continue
+            if state == PENDING:
+                challenge.get("users")[user_id] = (join_id, name)
+            elif state == FAILED:
+                challenge.get("clean").add(join_id)
+        return list(challenges.values())
+
+    def _run(self) -> None:
+        while (item := self._queue.get()) is not None:
+            items = [item]
+            deadline = time.time() + self.interval
+            while len(items) < self.batch:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                items.append(item)
+            self._commit(items)
+
+    def _commit(self, items: List[Tuple[str, tuple]]) -> None:
+        # Any error is handled here, the writer thread must outlive it.
+        for attempt in range(1, RETRIES + 1):
+            try:
+                with self._lock:
+                    self._write(items)
+                return
+            except sqlite3.OperationalError as err:
+                # Transient, e.g. another worker held the lock past BUSY_TIMEOUT.
+                logger.warning(
+                    "Store: Failed to write %d changes, attempt %d: %s",
+                    len(items),
+                    attempt,
+                    err,
+                )
+                time.sleep(self.interval * 2**attempt)
+            except Exception as err:
+                logger.error("Store: Failed to write %d changes: %s", len(items), err)
+                break
+        logger.error("Store: Dropped %d changes", len(items))
+
+    def _write(self, items: List[Tuple[str, tuple]]) -> None:
+        self.db.execute("BEGIN")
+        try:
+            for sql, group in groupby(items, key=lambda t: t[0]):
+                self.db.executemany(sql, [params for _, params in group])
+            self.db.execute("COMMIT")
+        except BaseException:
+            if self.db.in_transaction:
+                self.db.execute("ROLLBACK")
+            raise
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout)
+        with self._lock:
+            self.db.close()
+
+
+class QuestionStore(object):
+    """SQLite question bank, questions are read on demand instead of at load
+
+    Live questions hold the dense slots 0..n-1, so a uniform sample is a single
+    indexed lookup. Deleting or editing a question only clears its slot, the
+    buttons already sent for it keep resolving by ID.
+    """
+
+    persistent = True
+
+    UPSERT = (
+        "INSERT INTO questions VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (id) DO UPDATE SET slot = excluded.slot WHERE slot IS NULL"
+    )
+
+    def __init__(self, filename: str, cache: int = 4096):
+        self.filename = filename
+        self._lock = threading.Lock()
+        # One connection per process, cluster workers fork after the store is
+        # built and must never use the handle of their parent.
+        self._connections: dict = dict()
+        self._size: Optional[int] = None
+        # Rows never change under an ID, only deleted IDs need to be forgotten.
+        self.get = lru_cache(cache)(self._get)
+
+    def __reduce__(self) -> tuple:
+        # Pickled config snapshots reopen the store instead of copying it.
+        return QuestionStore, (self.filename,)
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        """Connection of the current process, opened on first use"""
+        if (db := self._connections.get(os.getpid())) is None:
+            db = self._connections[os.getpid()] = sqlite3.connect(
+                self.filename,
+                timeout=BUSY_TIMEOUT,
+                check_same_thread=False,
+                isolation_level=None,
+            )
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS questions (id INTEGER PRIMARY KEY, "
+                "slot INTEGER UNIQUE, question TEXT, answer TEXT, wrong TEXT, key TEXT)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            # Casefolded question texts of the live questions, for search.
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS questions_key ON questions (key) "
+                "WHERE slot IS NOT NULL"
+            )
+        return db
+
+    def __len__(self) -> int:
+        if self._size is None:
+            with self._lock:
+                self._size = self._count()
+        return self._size
+
+    def _count(self) -> int:
+        return self.db.execute(
+            "SELECT coalesce(max(slot) + 1, 0) FROM questions"
+        ).fetchone()[0]
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        with self._lock:
+            # Other workers share the file, take the write lock before counting.
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            self._size = self._count()
+
+    def _get(self, question: int) -> Optional[Challenge]:
+        with self._lock:
+            row = self.db.execute(
+                "SELECT question, answer, wrong FROM questions WHERE id = ?",
+                (question,),
+            ).fetchone()
+        if not row:
+            return None
+        return compile_challenge(
+            dict(QUESTION=row[0], ANSWER=row[1], WRONG=json.loads(row[2]))
+        )
+
+    def position(self, question: int) -> Optional[int]:
+        with self._lock:
+            return self._slot(question)
+
+    def at(self, num: int) -> Optional[Challenge]:
+        with self._lock:
+            row = self.db.execute(
+                "SELECT id FROM questions WHERE slot = ?", (num,)
+            ).fetchone()
+        return self.get(row[0]) if row else None
+
+    def sample(self) -> Challenge:
+        while True:
+            if (size := len(self)) and (
+                challenge := self.at(SystemRandom().randrange(size))
+            ):
+                return challenge
+            # Another worker resized the bank since this one last counted.
+            with self._lock:
+                self._size = self._count()
+            assert self._size, f"Config: No questions left in {self.filename}."
+
+    def page(self, offset: int, limit: int) -> List[Challenge]:
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT id FROM questions WHERE slot >= ? ORDER BY slot LIMIT ?",
+                (offset, limit),
+            ).fetchall()
+        return [self.get(question) for (question,) in rows]
+
+    def search(self, text: str) -> List[int]:
+        """IDs of the questions containing text, those starting with it first"""
+        text = text.casefold()
+        bounds = (text, text + "\U0010ffff")
+        with self._lock:
+            # Prefixes are a range of the key index, substrings scan only the index,
+            # both in key order so no table row is read.
+            prefix = self.db.execute(
+                "SELECT id FROM questions WHERE slot IS NOT NULL "
+                "AND key >= ? AND key < ? ORDER BY key",
+                bounds,
+            ).fetchall()
+            rest = self.db.execute(
+                "SELECT id FROM questions WHERE slot IS NOT NULL "
+                "AND instr(key, ?) AND NOT (key >= ? AND key < ?) ORDER BY key",
+                (text, *bounds),
+            ).fetchall()
+        return [question for (question,) in prefix + rest]
+
+    def _insert(self, slot: int, flag: dict) -> bool:
+        check_question(flag)
+        challenge = compile_challenge(flag)
+        return bool(
+            self.db.execute(
+                self.UPSERT,
+                (
+                    challenge.id,
+                    slot,
+                    challenge.question,
+                    challenge.answer,
+                    json.dumps(challenge.wrong, ensure_ascii=False),
+                    challenge.question.casefold(),
+                ),
+            ).rowcount
+        )
+
+    def seed(self, flags: Iterable[dict]) -> int:
+        """Add flags to a new store, return the number added
+
+        A store is seeded once, a bank its admins emptied is not filled again.
+        """
+        with self._transaction():
+            if (
+                not self.db.execute(
+                    "INSERT OR IGNORE INTO meta VALUES ('seeded', '1')"
+                ).rowcount
+                or self._count()
+            ):
+                return 0
+            size = 0
+            for flag in flags:
+                # A duplicate of a live question takes no slot.
+                size += self._insert(size, flag)
+        logger.info(f"Questions: Seeded {self.filename} with {size} questions")
+        return size
+
+    def extend(self, flags: Iterable[dict]) -> int:
+        """Append flags, return the number of new questions"""
+        with self._transaction():
+            size = start = self._count()
+            for flag in flags:
+                size += self._insert(size, flag)
+        return size - start
+
+    def _slot(self, question: int) -> Optional[int]:
+        row = self.db.execute(
+            "SELECT slot FROM questions WHERE id = ? AND slot IS NOT NULL",
+            (question,),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, question: int, flag: dict) -> None:
+        """Replace the question with ID question, or append flag when there is none"""
+        with self._transaction():
+            size = self._count()
+            if (num := self._slot(question)) is None:
+                self._insert(size, flag)
+                return
+            self.db.execute("UPDATE questions SET slot = NULL WHERE slot = ?", (num,))
+            if not self._insert(num, flag):
+                # The edit duplicates another live question, drop the slot.
+                self._compact(num, size)
+
+    def delete(self, question: int) -> Optional[Challenge]:
+        with self._transaction():
+            if (num := self._slot(question)) is None:
+                return None
+            size = self._count()
+            self.db.execute("UPDATE questions SET slot = NULL WHERE slot = ?", (num,))
+            self._compact(num, size)
+        return self.get(question)
+
+    def _compact(self, hole: int, size: int) -> None:
+        """Move the last question into the emptied slot hole"""
+        if hole != size - 1:
+            self.db.execute(
+                "UPDATE questions SET slot = ? WHERE slot = ?", (hole, size - 1)
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            # Handles inherited from the parent process are left to it.
+            if (db := self._connections.pop(os.getpid(), None)) is not None:
+                db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import questions into a store.")
+    parser.add_argument("store", help="path of the QUESTION_STORE file", type=str)
+    parser.add_argument(
+        "file",
+        help="YAML or JSON file with a CHALLENGE list, or the list itself",
+        type=str,
+    )
+    args = parser.parse_args()
+    with open(args.file, "r", encoding="utf-8") as file:
+        flags = yaml.load(file)
+    if isinstance(flags, dict):
+        flags = flags.get("CHALLENGE")
+    store = QuestionStore(args.store)
+    added = store.extend(flags)
+    print(f"Imported {added} new questions, {len(store)} in {args.store}")
+    store.close()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+from datetime import datetime
+from queue import Empty
+
+import pytest
+from telegram import Chat, Message, Update
+
+from cluster import Cluster
+from store import ChallengeStore
+
+CHATS = (-1001, -1002, -1003, -1004, -1005, -1006, 42)
+
+
+def chat_id(data: dict):
+    return (data.get("message") or dict()).get("chat", dict()).get("id")
+
+
+def update(update_id: int, chat_id: int) -> Update:
+    chat = Chat(chat_id, "supergroup" if chat_id < 0 else "private")
+    return Update(update_id, message=Message(update_id, datetime.now(), chat))
+
+
+def test_route_keeps_chat_on_one_worker():
+    cluster = Cluster(3)
+    routed = [CHATS[num % len(CHATS)] for num in range(3 * len(CHATS))]
+    for num, chat in enumerate(routed):
+        cluster.route(update(num, chat), None)
+    cluster.route(Update(99), None)
+    for index, queue in enumerate(cluster._queues):
+        expected = [chat for chat in routed if cluster.shard(chat) == index]
+        if index == 0:
+            # Updates without a chat go to the first worker.
+            expected.append(None)
+        assert [chat_id(queue.get(timeout=1)) for _ in expected] == expected
+        with pytest.raises(Empty):
+            queue.get(timeout=0.1)
+
+
+def test_route_matches_store_shard(tmp_path):
+    store = ChallengeStore(os.path.join(tmp_path, "challenges.db"))
+    cluster = Cluster(3)
+    try:
+        for chat in CHATS:
+            store.add(chat, 1, 0, "", 0, [])
+        store.close()
+        store = ChallengeStore(os.path.join(tmp_path, "challenges.db"))
+        # Each worker replays exactly the chats routed to it.
+        for index in range(cluster.processes):
+            rows = store.load(shard=(index, cluster.processes))
+            assert sorted(row.get("chat_id") for row in rows) == sorted(
+                chat for chat in CHATS if cluster.shard(chat) == index
+            )
+    finally:
+        store.close()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+
+import pytest
+from telegram import User
+from telegram.ext import Defaults, ExtBot, MessageHandler, Updater
+from telegram.ext.filters import Filters
+
+from ingress import Ingress
+
+
+def message(update_id, chat_type="supergroup", **fields):
+    body = dict(
+        message_id=update_id,
+        date=int(time.time()),
+        chat=dict(id=-100 if chat_type != "private" else 1, type=chat_type),
+        **fields,
+    )
+    return json.dumps(dict(update_id=update_id, message=body)).encode()
+
+
+@pytest.fixture
+def updater():
+    bot = ExtBot("123:TEST", defaults=Defaults(run_async=True))
+    # Stands in for getMe, the tests never reach Telegram.
+    bot._bot = User(123, "Test", True, username="test_bot")
+    updater = Updater(bot=bot, workers=2)
+    yield updater
+    updater.dispatcher.stop()
+
+
+def test_gate_bounds_handlers_in_flight(updater):
+    release = threading.Event()
+    running, peak, handled = [0], [0], list()
+    lock = threading.Lock()
+
+    def handler(update, context):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        release.wait(5)
+        with lock:
+            running[0] -= 1
+            handled.append(update.update_id)
+
+    updater.dispatcher.add_handler(MessageHandler(Filters.all, handler))
+    threading.Thread(target=updater.dispatcher.start, daemon=True).start()
+    ingress = Ingress(updater, "/hook", port=0)
+    ingress.start()
+    for update_id in range(6):
+        assert ingress.put(message(update_id, text="hi"))
+    time.sleep(0.3)
+    stats = ingress.stats()
+    assert stats.get("in_flight") == 2
+    assert stats.get("depth") == 4
+    release.set()
+    for _ in range(50):
+        if len(handled) == 6:
+            break
+        time.sleep(0.1)
+    assert sorted(handled) == list(range(6))
+    assert peak[0] == 2
+    assert ingress.stats().get("in_flight") == 0
+    ingress.stop()
+
+
+def test_evict_only_group_traffic(updater):
+    ingress = Ingress(updater, "/hook", port=0, size=3)
+    ingress.put(message(1, text="hi"))
+    ingress.put(message(2, new_chat_members=[dict(id=2, is_bot=False, first_name="A")]))
+    ingress.put(message(3, chat_type="private", text="/start"))
+    assert ingress.put(message(4, chat_type="private", text="/start"))
+    assert ingress.dropped == 1
+    assert not ingress.put(message(5, text="hi"))
+    assert ingress.rejected == 1
+    ingress._server.server_close()
+
+
+def test_full_queue_of_joins_stays_cheap(updater):
+    ingress = Ingress(updater, "/hook", port=0, size=10000)
+    joiner = dict(id=2, is_bot=False, first_name="A")
+    for update_id in range(10000):
+        assert ingress.put(message(update_id, new_chat_members=[joiner]))
+    start = time.perf_counter()
+    for update_id in range(200):
+        assert not ingress.put(message(update_id, text="hi"))
+    # Nothing queued is parsed again to find an update to evict.
+    assert time.perf_counter() - start < 1
+    assert ingress.rejected == 200 and ingress.stats().get("depth") == 10000
+    ingress._server.server_close()
+
+
+def test_shed_only_late_group_traffic(updater):
+    handled = list()
+    updater.dispatcher.add_handler(
+        MessageHandler(Filters.all, lambda update, _: handled.append(update.update_id))
+    )
+    ingress = Ingress(updater, "/hook", port=0, max_age=0)
+    ingress.put(message(1, text="hi"))
+    ingress.put(message(2, new_chat_members=[dict(id=2, is_bot=False, first_name="A")]))
+    ingress.put(message(3, chat_type="private", text="/start"))
+    threading.Thread(target=updater.dispatcher.start, daemon=True).start()
+    ingress.start()
+    for _ in range(50):
+        if len(handled) == 2:
+            break
+        time.sleep(0.1)
+    ingress.stop()
+    assert sorted(handled) == [2, 3]
+    assert ingress.shed == 1
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+from telegram import Chat, User
+
+import main
+from benchmark import make_config, make_context
+from outbox import RESTRICT
+from scheduler import TimerWheel
+from shard import Shards
+from store import ChallengeStore
+from tokens import option_index, sign_options, verify
+from utils import load_config
+
+CHAT = Chat(-100, "supergroup")
+
+
+class HeldOutbox(object):
+    """Outbox running calls inline, restrictions wait until release"""
+
+    def __init__(self):
+        self.held = list()
+
+    def submit(self, priority: int, chat_id: int, func, /, *args, **kwargs):
+        future: Future = Future()
+        if priority == RESTRICT:
+            self.held.append((future, func, args, kwargs))
+        else:
+            future.set_result(func(*args, **kwargs))
+        return future
+
+    def release(self) -> None:
+        held, self.held = self.held, list()
+        for future, func, args, kwargs in held:
+            future.set_result(func(*args, **kwargs))
+
+
+class Message(SimpleNamespace):
+    def edit_text(self, text: str, **kwargs) -> None:
+        self.edits.append((text, kwargs.get("reply_markup")))
+
+
+class CallbackQuery(SimpleNamespace):
+    def answer(self, **kwargs) -> None:
+        self.answers.append(kwargs.get("text"))
+
+
+@pytest.fixture
+def context(tmp_path):
+    config = load_config(make_config(3))
+    context = make_context(config, str(tmp_path))
+    context.bot_data["outbox"] = HeldOutbox()
+    context.bot_data["snapshots"] = {config.get("version"): config}
+    calls = list()
+    context.bot.ban_chat_member = lambda **kwargs: calls.append(("ban", kwargs))
+    context.bot.restrict_chat_member = lambda **kwargs: calls.append(
+        ("restrict", kwargs)
+    )
+    sent = list()
+    send_message = context.bot.send_message
+    context.bot.send_message = lambda **kwargs: sent.append(kwargs) or send_message(
+        **kwargs
+    )
+    context.bot.edit_message_reply_markup = lambda **kwargs: calls.append(
+        ("markup", kwargs)
+    )
+    cleaned = list()
+    context.bot_data["cleaner"] = SimpleNamespace(
+        add=lambda chat_id, message_id: cleaned.append(message_id)
+    )
+    context.calls, context.sent, context.cleaned = calls, sent, cleaned
+    context.job_queue = SimpleNamespace(run_once=lambda *args, **kwargs: None)
+    yield context
+    context.bot_data.get("store").close()
+
+
+def join(context, *users: User) -> SimpleNamespace:
+    message = SimpleNamespace(
+        chat=CHAT, from_user=users[0], new_chat_members=list(users), message_id=1
+    )
+    main.newmem(SimpleNamespace(message=message), context)
+    context.bot_data.get("outbox").release()
+    (message_id,) = context.bot_data.get("shards").get(CHAT.id).challenges
+    return Message(
+        chat=CHAT,
+        message_id=message_id,
+        reply_markup=context.sent[-1].get("reply_markup"),
+        edits=list(),
+    )
+
+
+def sweep(context, key: str = "TIME") -> None:
+    """Run expire as the wheel would once every deadline has passed"""
+    deadline = time.time() + context.bot_data.get("config").get(key) + 2
+    main.expire(context, context.bot_data.get("wheel").advance(deadline))
+
+
+def restart(context, tmp_path) -> None:
+    """Drop everything in memory and replay the stored challenges"""
+    context.bot_data.get("store").close()
+    context.bot_data.update(
+        store=ChallengeStore(str(tmp_path / "bench.db")),
+        shards=Shards(),
+        wheel=TimerWheel(None),
+    )
+    main.replay(context)
+
+
+def buttons(context) -> dict:
+    """Callback data of the last greeting by option index, 0 is the answer"""
+    key = context.bot_data.get("secret")
+    rows = context.sent[-1].get("reply_markup").inline_keyboard
+    options = dict()
+    for row in rows:
+        if (token := verify(key, row[0].callback_data)) is not None:
+            options[option_index(key, token, 4)] = row[0].callback_data
+    return options
+
+
+def press(context, message, user: User, data: str) -> list:
+    callback_query = CallbackQuery(
+        from_user=user, message=message, data=data, answers=list()
+    )
+    main.query(SimpleNamespace(callback_query=callback_query), context)
+    return callback_query.answers
+
+
+def test_query_resolves_round_trip(context):
+    user = User(11, "A", False)
+    message = join(context, user)
+    assert press(context, message, user, buttons(context)[0]) == [
+        context.bot_data.get("config").get("SUCCESS")
+    ]
+    context.bot_data.get("outbox").release()
+    assert [name for name, _ in context.calls] == ["restrict", "restrict"]
+    text, markup = message.edits[-1]
+    assert "passed" in text and markup is None
+    # The results stay up until the deadline, then the greeting is cleaned.
+    assert not context.cleaned
+    sweep(context)
+    assert context.cleaned == [message.message_id]
+    assert not context.bot_data.get("shards").get(CHAT.id).challenges
+
+
+def test_second_press_gets_no_verdict(context):
+    user = User(11, "A", False)
+    message = join(context, user)
+    options = buttons(context)
+    # Wrong first, then right before the ban has been answered.
+    config = context.bot_data.get("config")
+    assert press(context, message, user, options[1]) != [config.get("OTHER")]
+    assert press(context, message, user, options[0]) == [config.get("OTHER")]
+    context.bot_data.get("outbox").release()
+    assert [name for name, _ in context.calls] == ["restrict", "ban"]
+    assert len(message.edits) == 1
+    sweep(context)
+    assert context.cleaned == [message.message_id, 1]
+    assert [name for name, _ in context.calls] == ["restrict", "ban"]
+
+
+def test_token_of_other_question_rejected(context):
+    user = User(11, "A", False)
+    message = join(context, user)
+    shard = context.bot_data.get("shards").get(CHAT.id)
+    asked = shard.challenges.get(message.message_id).get("question")
+    bank = context.bot_data.get("config").get("bank")
+    other = next(bank.at(num) for num in range(len(bank)) if bank.at(num).id != asked)
+    # Validly signed, but issued for another message of the chat.
+    ((forged,), *_) = sign_options(
+        context.bot_data.get("secret"),
+        CHAT.id,
+        0,
+        other.id,
+        (other.answer, *other.wrong),
+        2**32 - 1,
+    )
+    config = context.bot_data.get("config")
+    assert press(context, message, user, forged.callback_data) == [
+        config.get("OTHER")
+    ]
+    assert user.id in shard.challenges.get(message.message_id).get("users")
+
+
+def test_shared_greeting_hides_answer(context):
+    first, second = User(11, "A", False), User(12, "B", False)
+    message = join(context, first, second)
+    options = buttons(context)
+    press(context, message, first, options[0])
+    text, markup = message.edits[-1]
+    assert markup is not None and "\\*\\*\\*" in text
+    press(context, message, second, options[0])
+    context.bot_data.get("outbox").release()
+    text, markup = message.edits[-1]
+    assert markup is None and text.count("passed") == 2
+
+
+def test_wrong_answer_locks_out_batch(context):
+    first, second = User(11, "A", False), User(12, "B", False)
+    message = join(context, first, second)
+    options = buttons(context)
+    config = context.bot_data.get("config")
+    # The first ruled out an option, the second may not try the others.
+    press(context, message, first, options[1])
+    context.bot_data.get("outbox").release()
+    assert press(context, message, second, options[0]) == [config.get("OTHER")]
+    _, markup = message.edits[-1]
+    rows = [row[0].callback_data for row in markup.inline_keyboard]
+    assert rows == [f"admin|pass|{second.id}"]
+    shard = context.bot_data.get("shards").get(CHAT.id)
+    assert second.id in shard.challenges.get(message.message_id).get("users")
+
+
+def test_admin_resolves_once(context):
+    first, second = User(11, "A", False), User(12, "B", False)
+    message = join(context, first, second)
+    config = context.bot_data.get("config")
+    admin = User(2, "admin", False)
+
+    def tap(user: User, data: str) -> list:
+        callback_query = CallbackQuery(
+            from_user=user, message=message, data=data, answers=list()
+        )
+        main.admin(SimpleNamespace(callback_query=callback_query), context)
+        return callback_query.answers
+
+    assert tap(second, f"admin|pass|{first.id}") == [config.get("OTHER")]
+    assert tap(admin, f"admin|kick|{second.id}") == [config.get("KICK_BTN")]
+    assert tap(admin, f"admin|pass|{second.id}") == [config.get("OTHER")]
+    context.bot_data.get("outbox").release()
+    assert [(name, kwargs.get("user_id")) for name, kwargs in context.calls][2:] == [
+        ("ban", second.id)
+    ]
+    # Only the first member is left to answer or to be handled.
+    _, markup = message.edits[-1]
+    assert [
+        row[0].callback_data
+        for row in markup.inline_keyboard
+        if row[0].callback_data.startswith("admin|")
+    ] == [f"admin|pass|{first.id}"]
+    assert tap(admin, f"admin|pass|{first.id}") == [config.get("PASS_BTN")]
+    text, markup = message.edits[-1]
+    assert markup is None and "kicked by admin" in text
+
+
+def test_raid_shares_one_message(context):
+    settings = make_config(3)
+    settings.update(RAID_THRESHOLD=2)
+    config = load_config(settings)
+    context.bot_data.update(config=config, snapshots={config.get("version"): config})
+    first, second, third = (User(num, str(num), False) for num in (11, 12, 13))
+    join(context, first)
+    for user in (second, third):
+        main.newmem(
+            SimpleNamespace(
+                message=SimpleNamespace(
+                    chat=CHAT, from_user=user, new_chat_members=[user], message_id=2
+                )
+            ),
+            context,
+        )
+    shard = context.bot_data.get("shards").get(CHAT.id)
+    raid = shard.raid.result()
+    assert set(shard.challenges.get(raid).get("users")) == {second.id, third.id}
+    assert len(context.sent) == 2
+    message = Message(
+        chat=CHAT,
+        message_id=raid,
+        reply_markup=context.sent[-1].get("reply_markup"),
+        edits=list(),
+    )
+    assert press(context, message, second, buttons(context)[0]) == [
+        config.get("SUCCESS")
+    ]
+    # Answers on the pinned message are counted, it is not edited.
+    assert not message.edits
+    sweep(context, "RAID_TIME")
+    context.bot_data.get("outbox").release()
+    assert sorted(
+        kwargs.get("user_id") for name, kwargs in context.calls if name == "ban"
+    ) == [first.id, third.id]
+    assert raid in context.cleaned and shard.raid is None
+
+
+def test_replay_keeps_sent_keyboard(context, tmp_path):
+    first, second = User(11, "A", False), User(12, "B", False)
+    message = join(context, first, second)
+    options = buttons(context)
+    restart(context, tmp_path)
+    assert not [name for name, _ in context.calls if name == "markup"]
+    # Tokens sent before the restart still verify, later edits keep the rows.
+    press(context, message, first, options[0])
+    _, markup = message.edits[-1]
+    answers = [
+        row
+        for row in markup.inline_keyboard
+        if row[0].callback_data in options.values()
+    ]
+    assert answers == message.reply_markup.inline_keyboard[: len(answers)]
+    assert len(answers) == 4
+
+
+def test_replay_drops_deleted_question(context, tmp_path):
+    user = User(11, "A", False)
+    message = join(context, user)
+    shard = context.bot_data.get("shards").get(CHAT.id)
+    asked = shard.challenges.get(message.message_id).get("question")
+    settings = make_config(3)
+    bank = context.bot_data.get("config").get("bank")
+    del settings["CHALLENGE"][bank.position(asked)]
+    context.bot_data.update(config=load_config(settings))
+    restart(context, tmp_path)
+    ((name, kwargs),) = [call for call in context.calls if call[0] == "markup"]
+    rows = kwargs.get("reply_markup").inline_keyboard
+    assert [button.callback_data.split("|")[0] for (button, *_) in rows] == ["admin"]
+
+
+def test_answered_cleanup_survives_restart(context, tmp_path):
+    user = User(11, "A", False)
+    message = join(context, user)
+    press(context, message, user, buttons(context)[1])
+    context.bot_data.get("outbox").release()
+    restart(context, tmp_path)
+    sweep(context)
+    assert context.cleaned == [message.message_id, 1]
+    restart(context, tmp_path)
+    assert not context.bot_data.get("shards").get(CHAT.id).challenges
+
+
+def test_global_actions_need_every_chat(tmp_path):
+    settings = make_config(3)
+    settings.update(CHAT=[-301, -302], SUPER_ADMIN=9)
+    settings["CHATS"] = {-303: dict(CHALLENGE=make_config(1).get("CHALLENGE"))}
+    context = make_context(load_config(settings), str(tmp_path))
+    admins = {-301: [2, 3], -302: [2], -303: [3]}
+    context.bot.get_chat_administrators = lambda chat_id: [
+        SimpleNamespace(user=User(user_id, "admin", False, username="admin"))
+        for user_id in admins.get(chat_id)
+    ]
+    try:
+        assert main.global_admin(context, 9)
+        assert not main.global_admin(context, 2)
+        context.user_data.update(chat=-301)
+        # -301 and -302 share the bank, only 2 admins both.
+        assert main.may_edit_bank(context, 2)
+        assert not main.may_edit_bank(context, 3)
+        context.user_data.update(chat=-303)
+        assert main.may_edit_bank(context, 3)
+        assert not main.may_edit_bank(context, 2)
+    finally:
+        context.bot_data.get("store").close()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import urllib.error
+import urllib.request
+
+import pytest
+
+import metrics
+from metrics import REGISTRY, Counter, Gauge, Histogram, MetricsServer
+
+
+@pytest.fixture
+def registry():
+    size = len(REGISTRY)
+    yield
+    del REGISTRY[size:]
+
+
+def test_histogram_exposition(registry):
+    histogram = Histogram("test_seconds", "Test latency", buckets=(0.01, 0.1))
+    for value in (0.005, 0.01, 0.05, 3):
+        histogram.observe(value, method="getMe")
+    # Buckets are cumulative and le is inclusive, +Inf holds every observation.
+    assert histogram.render().splitlines() == [
+        "# HELP test_seconds Test latency",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{method="getMe",le="0.01"} 2',
+        'test_seconds_bucket{method="getMe",le="0.1"} 3',
+        'test_seconds_bucket{method="getMe",le="+Inf"} 4',
+        'test_seconds_sum{method="getMe"} 3.065',
+        'test_seconds_count{method="getMe"} 4',
+    ]
+
+
+def test_counter_and_gauge_exposition(registry):
+    counter = Counter("test_total", "Test counter")
+    counter.inc(result="pass", chat='say "hi"\\')
+    counter.inc(2, chat='say "hi"\\', result="pass")
+    counter.inc()
+    Gauge("test_depth", "Test gauge", lambda: 7)
+    Gauge("test_broken", "Test broken gauge", lambda: 1 / 0)
+    text = metrics.render()
+    assert text.endswith("\n")
+    # Labels are sorted and escaped, keyword order is one series.
+    assert 'test_total{chat="say \\"hi\\"\\\\",result="pass"} 3' in text
+    assert "test_total 1" in text.splitlines()
+    assert "test_depth 7.0" in text.splitlines()
+    # A gauge failing to read keeps its header but reports no sample.
+    assert text.splitlines()[-2:] == [
+        "# HELP test_broken Test broken gauge",
+        "# TYPE test_broken gauge",
+    ]
+
+
+def test_server(registry):
+    Counter("test_served_total", "Test counter").inc()
+    server = MetricsServer(0)
+    server.start()
+    url = f"http://127.0.0.1:{server._server.server_port}"
+    try:
+        with urllib.request.urlopen(f"{url}/metrics", timeout=5) as response:
+            assert response.headers.get("Content-Type").startswith("text/plain")
+            assert "test_served_total 1" in response.read().decode().splitlines()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"{url}/other", timeout=5)
+    finally:
+        server.stop()
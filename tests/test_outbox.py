@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+from telegram.error import BadRequest, InvalidToken
+
+from benchmark import StubOutbox
+from outbox import ANSWER, DELETE, GREET, RESTRICT, Cleaner, Outbox, TokenBucket
+
+
+class DeleteBot(object):
+    """Bot recording deletions, deleteMessages raises error when set"""
+
+    def __init__(self, error: Exception = None):
+        self.error = error
+        self.bulk = list()
+        self.single = list()
+
+    def _post(self, method: str, data: dict) -> bool:
+        if self.error:
+            raise self.error
+        self.bulk.append((data.get("chat_id"), data.get("message_ids")))
+        return True
+
+    def delete_message(self, chat_id: int, message_id: int) -> bool:
+        self.single.append((chat_id, message_id))
+        return True
+
+
+@pytest.fixture
+def outbox():
+    outbox = Outbox(workers=1, rate=1000, chat_rate=10, chat_burst=2)
+    yield outbox
+    outbox.stop()
+
+
+def test_bucket_delay():
+    bucket = TokenBucket(rate=2, burst=1)
+    now = bucket.stamp
+    assert bucket.delay(now) == 0
+    bucket.take()
+    assert bucket.delay(now) == pytest.approx(0.5)
+    assert bucket.delay(now + 0.5) == 0
+    # Idle time refills up to burst only.
+    assert bucket.delay(now + 60) == 0 and bucket.tokens == 1
+
+
+def test_priority_order(outbox):
+    calls = list()
+    # Queued while the outbox thread waits, so it sees every call at once.
+    with outbox._cond:
+        futures = [
+            outbox.submit(priority, None, calls.append, priority)
+            for priority in (DELETE, GREET, ANSWER, RESTRICT, GREET)
+        ]
+    for future in futures:
+        future.result(timeout=5)
+    assert calls == [RESTRICT, ANSWER, GREET, GREET, DELETE]
+
+
+def test_chat_bucket_throttles_only_its_chat(outbox):
+    done = dict()
+    lock = threading.Lock()
+
+    def call(name: str) -> None:
+        with lock:
+            done[name] = time.monotonic()
+
+    start = time.monotonic()
+    with outbox._cond:
+        futures = [outbox.submit(GREET, -1, call, f"a{num}") for num in range(4)]
+        futures.append(outbox.submit(GREET, -2, call, "b"))
+    for future in futures:
+        future.result(timeout=5)
+    # A burst of 2, then one call every 0.1s for chat -1.
+    assert done["a1"] - start < 0.05
+    assert done["a2"] - start >= 0.08 and done["a3"] - start >= 0.18
+    # Chat -2 has its own bucket and is not queued behind -1.
+    assert done["b"] < done["a2"]
+
+
+def test_cleaner_batches_per_chat():
+    bot = DeleteBot()
+    cleaner = Cleaner(bot, StubOutbox(), delay=60, size=3)
+    for message_id in range(1, 6):
+        cleaner.add(-1, message_id)
+    cleaner.add(-2, 9)
+    # A full batch goes at once, the rest waits for the delay or a flush.
+    assert bot.bulk == [(-1, [1, 2, 3])]
+    cleaner.flush()
+    assert sorted(bot.bulk) == [(-1, [1, 2, 3]), (-1, [4, 5])]
+    # A single message needs no bulk call.
+    assert bot.single == [(-2, 9)]
+
+
+def test_cleaner_falls_back_to_single_deletes():
+    bot = DeleteBot(BadRequest("Message to delete not found"))
+    cleaner = Cleaner(bot, StubOutbox(), delay=60)
+    cleaner.add(-1, 1)
+    cleaner.add(-1, 2)
+    cleaner.flush(-1)
+    assert bot.single == [(-1, 1), (-1, 2)]
+    # Only that batch failed, the next one tries deleteMessages again.
+    bot.error = None
+    cleaner.add(-1, 3)
+    cleaner.add(-1, 4)
+    cleaner.flush(-1)
+    assert bot.bulk == [(-1, [3, 4])]
+
+
+def test_cleaner_without_bulk_method():
+    bot = DeleteBot(InvalidToken())
+    cleaner = Cleaner(bot, StubOutbox(), delay=60)
+    for message_id in (1, 2, 3, 4):
+        cleaner.add(-1, message_id)
+        if message_id == 2:
+            cleaner.flush(-1)
+    bot.error = None
+    cleaner.flush(-1)
+    # Once the Bot API lacks deleteMessages, it is not tried again.
+    assert not bot.bulk
+    assert bot.single == [(-1, 1), (-1, 2), (-1, 3), (-1, 4)]
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from scheduler import TimerWheel
+
+
+def make_wheel() -> TimerWheel:
+    wheel = TimerWheel(None, tick=1.0, slots=8)
+    wheel._cursor = 100
+    return wheel
+
+
+def test_fires_at_deadline():
+    wheel = make_wheel()
+    wheel.add("a", 103, "value")
+    assert wheel.advance(102) == []
+    assert wheel.advance(103) == [("a", "value")]
+    assert len(wheel) == 0 and "a" not in wheel
+
+
+def test_past_deadline_fires_next_tick():
+    wheel = make_wheel()
+    wheel.add("a", 50)
+    assert wheel.advance(101) == [("a", None)]
+
+
+def test_deadline_beyond_one_turn():
+    wheel = make_wheel()
+    wheel.add("a", 100 + 8 * 3 + 1)
+    assert wheel.advance(100 + 8 * 3) == []
+    assert wheel.advance(100 + 8 * 3 + 1) == [("a", None)]
+
+
+def test_rearm_replaces_entry():
+    wheel = make_wheel()
+    wheel.add("a", 102, 1)
+    wheel.add("a", 105, 2)
+    assert len(wheel) == 1
+    assert wheel.advance(104) == []
+    assert wheel.advance(105) == [("a", 2)]
+
+
+def test_cancel():
+    wheel = make_wheel()
+    wheel.add("a", 102, "value")
+    assert wheel.cancel("a") == "value"
+    assert wheel.cancel("a") is None
+    assert "a" not in wheel
+    assert wheel.advance(110) == []
+
+
+def test_add_many():
+    wheel = make_wheel()
+    wheel.add_many([("a", 101), ("b", 102), ("c", 102)])
+    assert len(wheel) == 3
+    assert sorted(key for key, _ in wheel.advance(102)) == ["a", "b", "c"]
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import sqlite3
+import time
+
+import pytest
+
+from store import ChallengeStore, QuestionStore
+from upload import validate
+from utils import question_id, yaml
+
+
+@pytest.fixture
+def challenges(tmp_path):
+    store = ChallengeStore(os.path.join(tmp_path, "challenges.db"), interval=0.01)
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def questions(tmp_path):
+    store = QuestionStore(os.path.join(tmp_path, "questions.db"))
+    yield store
+    store.close()
+
+
+def flag(text: str) -> dict:
+    return dict(QUESTION=text, ANSWER="right", WRONG=["wrong"])
+
+
+def wait(store: ChallengeStore) -> None:
+    deadline = time.time() + 5
+    while store._queue.qsize() and time.time() < deadline:
+        time.sleep(0.01)
+    # The last batch may still be committing.
+    time.sleep(0.05)
+
+
+def test_challenge_roundtrip(challenges):
+    challenges.add(-100, 1, 42, "text", 1000.0, [(11, 5, "A"), (12, 6, "B")])
+    challenges.resolve(-100, 1, 12, False)
+    wait(challenges)
+    (row,) = challenges.load()
+    assert row.get("question") == 42 and row.get("deadline") == 1000.0
+    assert row.get("users") == {11: (5, "A")}
+    assert row.get("clean") == {6}
+    assert not row.get("raid")
+    challenges.remove(-100, 1)
+    wait(challenges)
+    assert challenges.load() == []
+
+
+def test_load_shard(challenges):
+    challenges.add(-100, 1, 42, "text", 1000.0, [])
+    challenges.add(-101, 1, 42, "text", 1000.0, [])
+    wait(challenges)
+    assert [row.get("chat_id") for row in challenges.load(shard=(0, 2))] == [-100]
+    assert [row.get("chat_id") for row in challenges.load(shard=(1, 2))] == [-101]
+
+
+def test_writer_survives_failed_batch(challenges):
+    challenges._queue.put(("INSERT INTO missing VALUES (?)", (1,)))
+    wait(challenges)
+    time.sleep(0.2)
+    challenges.add(-100, 1, 42, "text", 1000.0, [])
+    wait(challenges)
+    assert challenges._thread.is_alive()
+    assert not challenges.db.in_transaction
+    assert [row.get("message_id") for row in challenges.load()] == [1]
+
+
+def test_raid_persisted(challenges):
+    challenges.add(-100, 1, 42, "text", 1000.0, [], raid=True)
+    challenges.add(-100, 1, 42, "text", 1000.0, [(11, 5, "A")], raid=True)
+    wait(challenges)
+    (row,) = challenges.load()
+    assert row.get("raid") and row.get("users") == {11: (5, "A")}
+
+
+def test_raid_column_added(tmp_path):
+    filename = os.path.join(tmp_path, "challenges.db")
+    db = sqlite3.connect(filename)
+    db.execute(
+        "CREATE TABLE challenges (chat_id INTEGER, message_id INTEGER, "
+        "question INTEGER, text TEXT, deadline REAL, "
+        "PRIMARY KEY (chat_id, message_id))"
+    )
+    db.execute("INSERT INTO challenges VALUES (-100, 1, 42, 'text', 1000.0)")
+    db.commit()
+    db.close()
+    store = ChallengeStore(filename, interval=0.01)
+    try:
+        (row,) = store.load()
+        assert row.get("raid") is False
+    finally:
+        store.close()
+
+
+def test_seed_only_when_empty(questions):
+    assert questions.seed([flag("a"), flag("b"), flag("a")]) == 2
+    assert len(questions) == 2
+    assert questions.seed([flag("c")]) == 0
+    assert [challenge.question for challenge in questions.page(0, 10)] == ["a", "b"]
+
+
+def test_seed_only_once(questions):
+    questions.seed([flag("a")])
+    questions.delete(question_id(flag("a")))
+    # Emptied by its admins, the bank is not seeded from the config again.
+    assert questions.seed([flag("b")]) == 0
+    with pytest.raises(AssertionError, match="No questions left"):
+        questions.sample()
+    questions.extend([flag("c")])
+    assert questions.sample().question == "c"
+
+
+def test_put_appends_or_replaces(questions):
+    questions.seed([flag("a"), flag("b")])
+    questions.put(question_id(flag("c")), flag("c"))
+    assert len(questions) == 3
+    questions.put(question_id(flag("a")), flag("d"))
+    assert [challenge.question for challenge in questions.page(0, 10)] == [
+        "d",
+        "b",
+        "c",
+    ]
+    assert questions.position(question_id(flag("a"))) is None
+    # The old ID still resolves, buttons already sent for it keep working.
+    assert questions.get(question_id(flag("a"))).question == "a"
+
+
+def test_delete_keeps_slots_dense(questions):
+    questions.seed([flag("a"), flag("b"), flag("c")])
+    assert questions.delete(question_id(flag("a"))).question == "a"
+    assert questions.delete(question_id(flag("a"))) is None
+    assert len(questions) == 2
+    assert questions.position(question_id(flag("a"))) is None
+    assert questions.position(question_id(flag("c"))) == 0
+    assert {questions.sample().question for _ in range(20)} <= {"b", "c"}
+
+
+def test_search(questions):
+    questions.seed([flag("Xab"), flag("abc"), flag("ABD"), flag("zz")])
+    found = [questions.get(question).question for question in questions.search("Ab")]
+    assert found == ["abc", "ABD", "Xab"]
+
+
+def test_reopened_after_pickle(questions):
+    questions.seed([flag("a")])
+    store = pickle.loads(pickle.dumps(questions))
+    try:
+        assert len(store) == 1 and store.at(0).question == "a"
+    finally:
+        store.close()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_connection_per_process(questions):
+    questions.seed([flag("a")])
+    reader, writer = os.pipe()
+    if (pid := os.fork()) == 0:
+        try:
+            fresh = questions.db is not questions._connections.get(os.getppid())
+            questions.extend([flag("b")])
+            os.write(writer, b"1" if fresh else b"0")
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(reader, 1) == b"1"
+    assert len(questions._connections) == 1
+    assert questions.page(0, 10)[-1].question == "b"
+
+
+def test_validate_leaves_question_store_alone(tmp_path):
+    live = os.path.join(tmp_path, "questions.db")
+    source = os.path.join(tmp_path, "upload.yml")
+    staged = os.path.join(tmp_path, "staged.yml")
+    with open(source, "w") as file:
+        file.write(
+            f"CHAT: -100\nQUESTION_STORE: {live}\n"
+            "CHALLENGE:\n- QUESTION: a\n  ANSWER: right\n  WRONG: [wrong]\n"
+        )
+    assert validate(source, staged, "1:TOKEN") == []
+    assert not os.path.exists(live)
+    assert not os.path.exists(f"{staged}.cache")
+    with open(staged) as file:
+        assert yaml.load(file).get("QUESTION_STORE") == live
+    assert [name for name in os.listdir(tmp_path) if name.endswith(".db")] == []
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import struct
+
+import pytest
+
+from tokens import PREFIX, Token, derive_key, option_index, sign, sign_options, verify
+
+KEY = derive_key("secret")
+EXPIRY = 2**32 - 1
+
+
+def test_sign_roundtrip():
+    token = Token(-1001234567890123, 2**62, 2**40, 3, EXPIRY, 65535)
+    data = sign(KEY, token)
+    assert data.startswith(PREFIX)
+    assert len(data.encode()) <= 54
+    assert verify(KEY, data) == token
+
+
+def test_tampered_or_foreign_rejected():
+    data = sign(KEY, Token(-100, 11, 42, 0, 1000, 7))
+    flipped = "A" if data[-1] != "A" else "B"
+    assert verify(KEY, data[:-1] + flipped) is None
+    assert verify(derive_key("other"), data) is None
+    assert verify(KEY, data[:-4]) is None
+    assert verify(KEY, PREFIX + "not base64!") is None
+
+
+def test_sign_options():
+    texts = ("right", "wrong 1", "wrong 2", "wrong 3")
+    rows = sign_options(KEY, -1001234567890123, 2**62, 2**40, texts, EXPIRY)
+    assert [[button.text for button in row] for row in rows] == [
+        [text] for text in texts
+    ]
+    tokens = [verify(KEY, row[0].callback_data) for row in rows]
+    assert all(len(row[0].callback_data.encode()) <= 54 for row in rows)
+    assert [option_index(KEY, token, len(texts)) for token in tokens] == [0, 1, 2, 3]
+    # One nonce per keyboard, only the rotated option differs.
+    assert len({token._replace(option=0) for token in tokens}) == 1
+    assert {token.expiry for token in tokens} == {EXPIRY}
+
+
+def test_expiry_out_of_range():
+    with pytest.raises(struct.error):
+        sign(KEY, Token(-100, 11, 42, 0, 2**32, 7))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from telegram.error import NetworkError
+
+from transport import PooledRequest
+from upload import download, validate
+
+BODY = b"CHAT: -100\n" * 1000
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path != "/file.yml":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_through_pool(server, tmp_path):
+    request = PooledRequest(1, pool_timeout=1)
+    path = os.path.join(tmp_path, "upload.yml")
+    download(request, f"{server}/file.yml", path, len(BODY), 5)
+    with open(path, "rb") as file:
+        assert file.read() == BODY
+    with pytest.raises(ValueError):
+        download(request, f"{server}/file.yml", path, len(BODY) - 1, 5)
+    with pytest.raises(NetworkError):
+        download(request, f"{server}/missing.yml", path, len(BODY), 5)
+    # Every connection went back, a pool of one still serves the next call.
+    assert request.stats().get("in_use") == 0
+    download(request, f"{server}/file.yml", path, len(BODY), 5)
+
+
+def test_validate_reports_every_error(tmp_path):
+    source = os.path.join(tmp_path, "upload.yml")
+    staged = os.path.join(tmp_path, "staged.yml")
+    with open(source, "w") as file:
+        file.write(
+            "CHAT: group\nTIME: soon\nGREET_BATCH: 100\n"
+            "CHATS:\n  -200:\n    TIME: -1\n"
+            "CHALLENGE:\n- QUESTION: a\n"
+        )
+    errors = validate(source, staged, "1:TOKEN")
+    assert errors[:3] == [
+        "Config: CHAT Must be ID, not username.",
+        "Config: TIME Should be a positive number of seconds.",
+        "Config: GREET_BATCH Should be between 1 and 40.",
+    ]
+    assert errors[3].startswith("CHATS.-200: Config: TIME ")
+    assert errors[4].startswith("CHALLENGE #1: ") and len(errors) == 5
+    assert not os.path.exists(staged)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import base64
+import binascii
+import hashlib
+import hmac
+import secrets
+import struct
+from typing import List, NamedTuple, Optional
+
+from telegram import InlineKeyboardButton
+
+PREFIX = "c|"
+# chat, user (0 lets any pending member answer), question, option, expiry, nonce
+LAYOUT = struct.Struct(">qqqBIH")
+TAG_SIZE = 8
+
+
+class Token(NamedTuple):
+    chat_id: int
+    user_id: int
+    question: int
+    option: int
+    expiry: int
+    nonce: int
+
+
+def derive_key(secret: str) -> bytes:
+    return hashlib.sha256(f"easyauth|callback|{secret}".encode()).digest()
+
+
+def _tag(key: bytes, payload: bytes) -> bytes:
+    return hmac.new(key, payload, hashlib.sha256).digest()[:TAG_SIZE]
+
+
+def _shift(key: bytes, token: Token, size: int) -> int:
+    # Options are rotated by a keyed offset, so the answer's code is not readable.
+    digest = hmac.new(
+        key,
+        struct.pack(">qqH", token.chat_id, token.question, token.nonce),
+        hashlib.sha256,
+    ).digest()
+    return int.from_bytes(digest[:4], "big") % size
+
+
+def sign(key: bytes, token: Token) -> str:
+    """Pack and sign token into at most 54 bytes of callback data"""
+    payload = LAYOUT.pack(*token)
+    encoded = base64.urlsafe_b64encode(payload + _tag(key, payload))
+    return PREFIX + encoded.rstrip(b"=").decode("ascii")
+
+
+def verify(key: bytes, data: str) -> Optional[Token]:
+    """Unpack data, None unless its tag matches"""
+    encoded = data[len(PREFIX) :]
+    try:
+        raw = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    if len(raw) != LAYOUT.size + TAG_SIZE:
+        return None
+    payload, tag = raw[: LAYOUT.size], raw[LAYOUT.size :]
+    if not hmac.compare_digest(tag, _tag(key, payload)):
+        return None
+    return Token(*LAYOUT.unpack(payload))
+
+
+def option_index(key: bytes, token: Token, size: int) -> int:
+    """Index of the chosen text in (answer, *wrong), 0 is the answer"""
+    return (token.option - _shift(key, token, size)) % size
+
+
+def sign_options(
+    key: bytes, chat_id: int, user_id: int, question: int, texts: tuple, expiry: int
+) -> List[List[InlineKeyboardButton]]:
+    """One button row per text of (answer, *wrong), in that order"""
+    token = Token(chat_id, user_id, question, 0, expiry, secrets.randbits(16))
+    shift = _shift(key, token, len(texts))
+    return [
+        [
+            InlineKeyboardButton(
+                text,
+                callback_data=sign(
+                    key, token._replace(option=(index + shift) % len(texts))
+                ),
+            )
+        ]
+        for index, text in enumerate(texts)
+    ]
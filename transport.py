@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import time
+from typing import Dict, Iterator, Optional
+
+from telegram.error import NetworkError, TimedOut
+from telegram.utils import request
+
+from metrics import HTTP_CONNECTIONS, HTTP_POOL_EXHAUSTED, HTTP_POOL_WAIT, TimedRequest
+
+# The urllib3 python-telegram-bot sends through, vendored unless unavailable.
+urllib3 = request.urllib3
+
+
+class PooledRequest(TimedRequest):
+    """Bot API transport over a blocking keep-alive pool of pool_size connections
+
+    Calls past pool_size wait up to pool_timeout for a free connection instead
+    of opening one that is thrown away afterwards, so every call reuses a warm
+    connection. timeouts maps Bot API methods to their read timeout.
+    """
+
+    __slots__ = (
+        "pool_timeout",
+        "timeouts",
+        "in_use",
+        "peak",
+        "exhausted",
+        "_lock",
+        "_local",
+    )
+
+    def __init__(
+        self,
+        pool_size: int,
+        pool_timeout: Optional[float] = 10,
+        connect_timeout: Optional[float] = 5.0,
+        read_timeout: Optional[float] = 5.0,
+        timeouts: Optional[Dict[str, float]] = None,
+        proxy_url: Optional[str] = None,
+    ):
+        super().__init__(
+            con_pool_size=pool_size,
+            proxy_url=proxy_url,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+        )
+        self.pool_timeout = pool_timeout
+        self.timeouts = timeouts or dict()
+        self.in_use = self.peak = self.exhausted = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if hasattr(self._con_pool, "connection_pool_kw"):
+            self._con_pool.connection_pool_kw["block"] = True
+            self._con_pool.pool_classes_by_scheme = {
+                scheme: self._instrument(pool)
+                for scheme, pool in self._con_pool.pool_classes_by_scheme.items()
+            }
+
+    def _instrument(self, base: type) -> type:
+        """Subclass the pool class base to account for this request"""
+        transport = self
+
+        class Connection(base.ConnectionCls):
+            def connect(self) -> None:
+                HTTP_CONNECTIONS.inc()
+                super().connect()
+
+        class Pool(base):
+            ConnectionCls = Connection
+
+            def _get_conn(self, timeout: float = None):
+                start = time.perf_counter()
+                try:
+                    conn = super()._get_conn(timeout=transport.pool_timeout)
+                except urllib3.exceptions.EmptyPoolError:
+                    with transport._lock:
+                        transport.exhausted += 1
+                    HTTP_POOL_EXHAUSTED.inc()
+                    transport._local.exhausted = True
+                    raise
+                finally:
+                    HTTP_POOL_WAIT.observe(time.perf_counter() - start)
+                with transport._lock:
+                    transport.in_use += 1
+                    transport.peak = max(transport.peak, transport.in_use)
+                return conn
+
+            def _put_conn(self, conn) -> None:
+                if getattr(transport._local, "exhausted", False):
+                    # urlopen hands back a None even when the wait timed out,
+                    # queueing it would let the pool grow past its size.
+                    transport._local.exhausted = False
+                    return
+                with transport._lock:
+                    transport.in_use -= 1
+                super()._put_conn(conn)
+
+        return Pool
+
+    def stats(self) -> dict:
+        """Pool size, connections checked out now and at most, and timed out waits"""
+        with self._lock:
+            return dict(
+                size=self.con_pool_size,
+                in_use=self.in_use,
+                peak=self.peak,
+                exhausted=self.exhausted,
+            )
+
+    def stream(
+        self, url: str, timeout: Optional[float] = None, chunk_size: int = 65536
+    ) -> Iterator[bytes]:
+        """Chunks of the file at url, fetched through the pool and its proxy"""
+        try:
+            response = self._con_pool.request(
+                "GET",
+                url,
+                preload_content=False,
+                timeout=urllib3.Timeout(connect=self._connect_timeout, read=timeout),
+            )
+        except urllib3.exceptions.TimeoutError as err:
+            raise TimedOut() from err
+        except urllib3.exceptions.HTTPError as err:
+            raise NetworkError(f"urllib3 HTTPError {err}") from err
+        try:
+            if not 200 <= response.status <= 299:
+                raise NetworkError(f"Download failed with HTTP {response.status}")
+            yield from response.stream(chunk_size)
+        except urllib3.exceptions.TimeoutError as err:
+            raise TimedOut() from err
+        except urllib3.exceptions.HTTPError as err:
+            raise NetworkError(f"urllib3 HTTPError {err}") from err
+        finally:
+            response.release_conn()
+
+    def post(self, url: str, data: Dict, timeout: float = None):
+        if timeout is None:
+            timeout = self.timeouts.get(url.rsplit("/", 1)[-1])
+        return super().post(url, data, timeout=timeout)
+
+
+def build_request(config: dict, pool_size: Optional[int] = None) -> PooledRequest:
+    """PooledRequest set up by the HTTP_* keys of config"""
+    return PooledRequest(
+        pool_size or config.get("HTTP_POOL") or config.get("WORKERS") + 4,
+        pool_timeout=config.get("HTTP_POOL_TIMEOUT"),
+        connect_timeout=config.get("HTTP_CONNECT_TIMEOUT"),
+        read_timeout=config.get("HTTP_READ_TIMEOUT"),
+        timeouts=config.get("HTTP_TIMEOUTS"),
+        proxy_url=config.get("HTTP_PROXY"),
+    )
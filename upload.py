@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+from multiprocessing.connection import Connection
+from typing import List
+
+from transport import PooledRequest
+from utils import (
+    ConfigWriter,
+    check_question,
+    load_config,
+    load_config_file,
+    persisted_view,
+    setting_errors,
+    yaml,
+)
+
+CHUNK_SIZE = 65536
+
+
+def download(
+    request: PooledRequest, url: str, path: str, limit: int, timeout: float
+) -> None:
+    """Stream url into path through request, giving up past limit bytes"""
+    size = 0
+    chunks = request.stream(url, timeout, CHUNK_SIZE)
+    try:
+        with open(path, "wb") as file:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > limit:
+                    raise ValueError(f"Config: File is larger than {limit} bytes.")
+                file.write(chunk)
+    finally:
+        # Hands the connection back to the pool even when giving up early.
+        chunks.close()
+
+
+def question_errors(config: dict) -> List[str]:
+    """Every problem of the question lists, where load_config stops at the first"""
+    errors = list()
+    chats = config.get("CHATS")
+    lists = [("CHALLENGE", config.get("CHALLENGE"))] + [
+        (f"CHATS.{chat}.CHALLENGE", override.get("CHALLENGE"))
+        for chat, override in (chats.items() if isinstance(chats, dict) else ())
+        if isinstance(override, dict)
+    ]
+    for name, flags in lists:
+        if flags is None:
+            continue
+        if not isinstance(flags, list):
+            errors.append(f"Config: {name} should be a list.")
+            continue
+        for num, flag in enumerate(flags, 1):
+            try:
+                assert isinstance(flag, dict), "Config: Question should be a mapping."
+                check_question(flag)
+            except AssertionError as err:
+                errors.append(f"{name} #{num}: {err}")
+    return errors
+
+
+def validate(source: str, staged: str, token: str) -> List[str]:
+    """Check source, then write it to staged with its compiled snapshot
+
+    Returns every error found, nothing is written unless the list is empty.
+    """
+    try:
+        with open(source, "rb") as file:
+            config = yaml.load(file.read().decode("utf-8"))
+    except Exception as err:
+        return [f"Yaml: {err}"]
+    if not isinstance(config, dict):
+        return ["Config: File should be a mapping."]
+    if errors := setting_errors(config, check_token=False) + question_errors(config):
+        return errors
+    # Question stores are compiled against throwaway copies, validating must
+    # neither seed nor attach to the files the bot serves from.
+    stores = [
+        (settings, settings.get("QUESTION_STORE"))
+        for settings in [config, *(config.get("CHATS") or dict()).values()]
+        if isinstance(settings, dict) and settings.get("QUESTION_STORE")
+    ]
+    for num, (settings, _) in enumerate(stores):
+        settings["QUESTION_STORE"] = f"{staged}.{num}.db"
+    try:
+        config = load_config(config, check_token=False)
+    except Exception as err:
+        return [str(err)]
+    finally:
+        for num, (settings, filename) in enumerate(stores):
+            settings["QUESTION_STORE"] = filename
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(f"{staged}.{num}.db{suffix}"):
+                    os.remove(f"{staged}.{num}.db{suffix}")
+    ConfigWriter._write(staged, persisted_view(config, token))
+    if not stores:
+        # Leaves staged.cache, so the reload after the swap skips compiling.
+        load_config_file(staged, check_token=False)
+    return list()
+
+
+def _validate(conn: Connection, source: str, staged: str, token: str) -> None:
+    try:
+        conn.send(validate(source, staged, token))
+    except Exception as err:
+        conn.send([str(err)])
+    finally:
+        conn.close()
+
+
+def check_upload(source: str, staged: str, token: str, timeout: float) -> List[str]:
+    """Run validate in a fresh process, killing it once timeout passes"""
+    # Spawn instead of fork, the bot's threads and locks stay in this process.
+    ctx = multiprocessing.get_context("spawn")
+    reader, writer = ctx.Pipe(duplex=False)
+    process = ctx.Process(
+        target=_validate,
+        args=(writer, source, staged, token),
+        name="ConfigValidator",
+        daemon=True,
+    )
+    process.start()
+    writer.close()
+    try:
+        if reader.poll(timeout):
+            return reader.recv()
+        return [f"Config: Validation did not finish in {timeout}s."]
+    except EOFError:
+        process.join()
+        return [f"Config: Validation exited with code {process.exitcode}."]
+    finally:
+        reader.close()
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+
+def join_errors(errors: List[str], size: int = 3500) -> str:
+    """Join errors into one message, Telegram takes at most 4096 characters"""
+    lines, total = list(), 0
+    for num, error in enumerate(errors):
+        if (total := total + len(error) + 1) > size:
+            lines.append(f"... {len(errors) - num} more")
+            break
+        lines.append(error)
+    return "\n".join(lines)
+
+
+def swap(staged: str, filename: str) -> None:
+    """Move the validated config and its snapshot over the live ones"""
+    # A snapshot never matches a file with another mtime, so either order is safe.
+    if os.path.exists(f"{staged}.cache"):
+        os.replace(f"{staged}.cache", f"{filename}.cache")
+    os.replace(staged, filename)
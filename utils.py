@@ -1,10 +1,26 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import copy
+import copyreg
+import gzip
+import json
 import logging
 import logging.handlers
 import os
+import pickle
+import queue
+import re
+import shutil
+import threading
 import time
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+from functools import cached_property, wraps
 from hashlib import blake2s
+from random import SystemRandom
+from types import MappingProxyType
+from typing import Callable, FrozenSet, List, Mapping, NamedTuple, Optional, Tuple
 
 from ruamel.yaml import YAML
 from telegram import ChatPermissions
@@ -23,6 +39,14 @@ FullChatPermissions = ChatPermissions(
 
 yaml = YAML()
 
+
+def frozen_mapping(mapping: dict) -> Mapping:
+    return MappingProxyType(mapping)
+
+
+# Compiled snapshots are pickled, teach pickle to rebuild read-only views.
+copyreg.pickle(MappingProxyType, lambda proxy: (frozen_mapping, (dict(proxy),)))
+
 logger = logging.getLogger("Telegram_Group_Easyauth")
 logger.setLevel(logging.DEBUG)
 
@@ -30,80 +54,234 @@ formater = logging.Formatter(
     "%(asctime)s - %(levelname)s - %(funcName)s[%(module)s:%(lineno)d] - %(message)s"
 )
 
-# Source: http://code.activestate.com/recipes/325905-memoize-decorator-with-timeout/#c1
-class MWT(object):
-    """Memoize With Timeout"""
+# Attributes every LogRecord has, anything else was passed through extra=.
+RECORD_KEYS = frozenset(vars(logging.makeLogRecord(dict()))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, fields passed through extra= included"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        event = dict(
+            time=round(record.created, 3),
+            level=record.levelname,
+            func=f"{record.module}.{record.funcName}",
+            message=record.getMessage(),
+        )
+        event.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in RECORD_KEYS
+        )
+        if record.exc_info:
+            event["exc"] = self.formatException(record.exc_info)
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records untouched, the listener thread formats them"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, respect_handler_level=True)
 
-    _caches: dict = dict()
-    _timeouts: dict = dict()
 
-    def __init__(self, timeout: int = 2):
+class TTLCache(object):
+    """Bounded LRU cache with single-flight loading and background refresh"""
+
+    def __init__(self, loader: Callable, timeout: int = 2, maxsize: int = 1024):
+        self.loader = loader
         self.timeout = timeout
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._loading: dict = dict()
+        self._lock = threading.Lock()
 
-    def collect(self):
-        """Clear cache of results which have timed out"""
-        for func in self._caches:
-            cache = {}
-            for key in self._caches[func]:
-                if (time.time() - self._caches[func][key][1]) < self._timeouts[func]:
-                    cache[key] = self._caches[func][key]
-            self._caches[func] = cache
+    def get(self, *args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                value, stamp = self._data[key]
+                if time.time() - stamp > self.timeout and key not in self._loading:
+                    # Serve the stale value, reload it once in the background.
+                    self._loading[key] = future = Future()
+                    threading.Thread(
+                        target=self._load, args=(key, future), daemon=True
+                    ).start()
+                return value
+            self.misses += 1
+            if owner := key not in self._loading:
+                self._loading[key] = Future()
+            future = self._loading[key]
+        if owner:
+            self._load(key, future)
+        return future.result()
 
-    def __call__(self, f):
-        self.cache = self._caches[f] = {}
-        self._timeouts[f] = self.timeout
+    def _load(self, key: tuple, future: Future) -> None:
+        args, kwargs = key
+        try:
+            value = self.loader(*args, **dict(kwargs))
+        except Exception as err:
+            logger.error(f"Cache: Failed to load {self.loader.__name__}{args}: {err}")
+            with self._lock:
+                self._loading.pop(key, None)
+            future.set_exception(err)
+            return
+        with self._lock:
+            self._data[key] = value, time.time()
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            self._loading.pop(key, None)
+        future.set_result(value)
 
-        def func(*args, **kwargs):
-            kw = sorted(kwargs.items())
-            key = (args, tuple(kw))
-            try:
-                v = self.cache[key]
-                if (time.time() - v[1]) > self.timeout:
-                    raise KeyError
-            except KeyError:
-                v = self.cache[key] = f(*args, **kwargs), time.time()
-            return v[0]
+    def invalidate(self, *args, **kwargs) -> None:
+        with self._lock:
+            self._data.pop((args, tuple(sorted(kwargs.items()))), None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                size=len(self._data),
+                ratio=self.hits / (self.hits + self.misses)
+                if self.hits + self.misses
+                else 0.0,
+            )
 
-        func.func_name = f.__name__
 
+def cached(timeout: int = 2, maxsize: int = 1024) -> Callable:
+    def decorator(f: Callable) -> Callable:
+        cache = TTLCache(f, timeout=timeout, maxsize=maxsize)
+
+        @wraps(f)
+        def func(*args, **kwargs):
+            return cache.get(*args, **kwargs)
+
+        func.cache = cache
         return func
 
+    return decorator
 
-@MWT(timeout=60 * 60)
-def get_chat_admins(bot: Bot, chat_id: int, extra_user=None) -> list:
-    if extra_user is not None and isinstance(extra_user, int):
-        users: list = [extra_user]
-    else:
-        users: list = extra_user
-    admins: list = [
-        admin.user.id
+
+class ChatAdmins(NamedTuple):
+    ids: FrozenSet[int]
+    names: str
+
+
+@cached(timeout=60 * 60)
+def get_chat_admins_record(bot: Bot, chat_id: int) -> ChatAdmins:
+    # bot.id is resolved by get_me() once at startup and reused afterwards.
+    users: list = [
+        admin.user
         for admin in bot.get_chat_administrators(chat_id)
-        if admin.user.id != bot.get_me().id
+        if admin.user.id != bot.id
     ]
-    if users:
-        admins.extend(users)
-    return admins
+    return ChatAdmins(
+        frozenset(user.id for user in users),
+        " ".join(f"@{user.username}" for user in users),
+    )
 
 
-@MWT(timeout=60 * 60)
-def get_chat_admins_name(bot: Bot, chat_id: int, extra_user=None) -> str:
+def get_chat_admins(bot: Bot, chat_id: int, extra_user=None) -> FrozenSet[int]:
     if extra_user is not None and isinstance(extra_user, int):
         users: list = [extra_user]
     else:
         users: list = extra_user
-    admins: list = [
-        f"@{admin.user.username}"
-        for admin in bot.get_chat_administrators(chat_id)
-        if admin.user.id != bot.get_me().id
-    ]
-    return " ".join(admins)
+    admins = get_chat_admins_record(bot, chat_id).ids
+    if users:
+        admins = admins.union(users)
+    return admins
 
 
-def log_to_stream() -> None:
+def get_chat_admins_name(bot: Bot, chat_id: int) -> str:
+    return get_chat_admins_record(bot, chat_id).names
+
+
+def escape_markdown(text: str) -> str:
+    # Use {} and reverse markdown carefully.
+    parse = re.sub(r"([_*\[\]()~`>\#\+\-=|\.!])", r"\\\1", text)
+    reparse = re.sub(r"\\\\([_*\[\]()~`>\#\+\-=|\.!])", r"\1", parse)
+    return reparse
+
+
+# Every character MarkdownV2 reserves, mapped to its escaped form.
+MARKDOWN_ESCAPE = str.maketrans({c: f"\\{c}" for c in "\\_*[]()~`>#+-=|{}.!"})
+
+MARKDOWN_TEMPLATES = (
+    "START",
+    "GREET",
+    "PASS",
+    "NOT_KICK",
+    "KICK",
+    "ADMIN_PASS",
+    "ADMIN_KICK",
+    "RAID",
+)
+
+
+def escape_value(text: str) -> str:
+    """Escape a dynamic value for MarkdownV2 in a single translate pass"""
+    return str(text).translate(MARKDOWN_ESCAPE)
+
+
+class Template(object):
+    """MarkdownV2 template escaped once per config load"""
+
+    __slots__ = ("source", "text")
+
+    def __init__(self, source: str):
+        self.source = source
+        self.text = escape_markdown(source)
+
+    def format(self, **kwargs) -> str:
+        return self.text.format(**kwargs)
+
+
+class Challenge(NamedTuple):
+    id: int
+    question: str
+    markdown: str
+    answer: str
+    wrong: Tuple[str, ...]
+
+
+def question_id(flag: dict) -> int:
+    """Stable 63-bit ID of a question, derived from its content"""
+    texts = [flag.get("QUESTION"), flag.get("ANSWER"), *flag.get("WRONG")]
+    digest = blake2s("\0".join(map(str, texts)).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") >> 1
+
+
+def compile_challenge(flag: dict) -> Challenge:
+    return Challenge(
+        id=question_id(flag),
+        question=flag.get("QUESTION"),
+        markdown=escape_markdown(flag.get("QUESTION")),
+        answer=str(flag.get("ANSWER")),
+        wrong=tuple(str(t) for t in flag.get("WRONG")),
+    )
+
+
+def log_to_stream(json_format: bool = False) -> None:
     streamhandler = logging.StreamHandler()
     streamhandler.setLevel(logging.INFO)
-    streamhandler.setFormatter(formater)
-    logger.addHandler(streamhandler)
+    streamhandler.setFormatter(JsonFormatter() if json_format else formater)
+    log_listener.handlers += (streamhandler,)
+
+
+def gzip_rotator(source: str, dest: str) -> None:
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
 
 
 def log_to_file(filename) -> None:
@@ -111,41 +289,359 @@ def log_to_file(filename) -> None:
         filename, maxBytes=1048576, backupCount=5, encoding="utf-8"
     )
     filehandler.setLevel(logging.DEBUG)
-    filehandler.setFormatter(formater)
-    logger.addHandler(filehandler)
+    filehandler.setFormatter(JsonFormatter())
+    # Rotation runs on the listener thread, compressing never blocks a handler.
+    filehandler.namer = lambda name: f"{name}.gz"
+    filehandler.rotator = gzip_rotator
+    log_listener.handlers += (filehandler,)
 
 
-def load_config(config: dict, check_token: bool = True) -> dict:
-    if check_token:
-        assert config.get("TOKEN"), "Config: No TOKEN."
-    if config.get("CHAT"):
-        assert isinstance(
-            config.get("CHAT"), int
-        ), "Config: CHAT Must be ID, not username."
-    else:
+def start_logging() -> None:
+    """Route logger through the queue to the handlers added so far"""
+    # Records below every handler's level are dropped before they are built.
+    logger.setLevel(min(handler.level for handler in log_listener.handlers))
+    if not any(isinstance(h, LazyQueueHandler) for h in logger.handlers):
+        logger.addHandler(LazyQueueHandler(log_queue))
+    log_listener.start()
+
+
+def stop_logging() -> None:
+    """Write out every queued record and stop the listener thread"""
+    if log_listener._thread:
+        log_listener.stop()
+
+
+# Credentials never written to the logs, in the shared settings or any chat's.
+SECRET_KEYS = ("TOKEN", "SECRET", "HTTP_PROXY")
+
+
+def redacted(settings: dict) -> dict:
+    return {
+        key: "<hidden>" if key in SECRET_KEYS and value else value
+        for key, value in settings.items()
+    }
+
+
+def dump_config(config: dict) -> None:
+    """Log the full persisted config, only on demand since it can be large"""
+    view = redacted(persisted_view(config, config.get("TOKEN")))
+    if view.get("CHATS"):
+        view["CHATS"] = {
+            chat: redacted(override) if isinstance(override, dict) else override
+            for chat, override in view.get("CHATS").items()
+        }
+    logger.info(
+        "Config: Dump of version %s\n%s",
+        config.get("version"),
+        json.dumps(view, ensure_ascii=False, default=str),
+        extra=dict(event="config_dump"),
+    )
+
+
+def check_question(flag: dict) -> None:
+    assert flag.get("QUESTION"), "Config: No QUESTION tile for question."
+    assert isinstance(
+        flag.get("QUESTION"), str
+    ), f"Config: QUESTION {flag.get('QUESTION')} should be string object."
+    assert flag.get(
+        "ANSWER"
+    ), f"Config: No ANSWER tile for question: {flag.get('QUESTION')}"
+    assert isinstance(
+        flag.get("ANSWER"), str
+    ), f"Config: ANSWER {flag.get('ANSWER')} should be string object for question: {flag.get('QUESTION')}"
+    assert flag.get(
+        "WRONG"
+    ), f"Config: No WRONG tile for question: {flag.get('QUESTION')}"
+    assert (
+        len(flag.get("WRONG")) < 20
+    ), f"Config: Too many tiles for WRONG for question: {flag.get('QUESTION')}"
+    assert all(
+        isinstance(u, str) for u in flag.get("WRONG")
+    ), f"Config: WRONG {flag.get('WRONG')} should all be string object for question: {flag.get('QUESTION')}"
+
+
+class SearchIndex(object):
+    """Case-insensitive prefix and substring search over question texts
+
+    Prefixes bisect the sorted texts, substrings intersect the trigram postings
+    of the search text before the candidates are checked.
+    """
+
+    def __init__(self, challenges: tuple):
+        self.ids = [challenge.id for challenge in challenges]
+        self.keys = [challenge.question.casefold() for challenge in challenges]
+        self.sorted = sorted((key, num) for num, key in enumerate(self.keys))
+        grams = defaultdict(list)
+        for num, key in enumerate(self.keys):
+            for gram in {key[i : i + 3] for i in range(len(key) - 2)}:
+                grams[gram].append(num)
+        self.grams = dict(grams)
+
+    def search(self, text: str) -> List[int]:
+        """IDs of the questions containing text, those starting with it first
+
+        Both groups are in text order, like the SQLite store returns them.
+        """
+        text = text.casefold()
+        start = bisect_left(self.sorted, (text,))
+        end = bisect_left(self.sorted, (text + "\U0010ffff",))
+        prefix = [num for _, num in self.sorted[start:end]]
+        if len(text) < 3:
+            candidates = range(len(self.keys))
+        else:
+            postings = sorted(
+                (self.grams.get(text[i : i + 3], ()) for i in range(len(text) - 2)),
+                key=len,
+            )
+            candidates = sorted(set(postings[0]).intersection(*postings[1:]))
+        seen = set(prefix)
+        rest = [num for num in candidates if num not in seen and text in self.keys[num]]
+        rest.sort(key=self.keys.__getitem__)
+        return [self.ids[num] for num in prefix + rest]
+
+
+class MemoryBank(object):
+    """Question bank compiled from the CHALLENGE list of the YAML config
+
+    Edits go to the CHALLENGE list, they take effect once the config is saved
+    and reloaded.
+    """
+
+    persistent = False
+
+    def __init__(self, flags: list):
+        for flag in flags:
+            check_question(flag)
+        self.flags = flags
+        self.index = tuple(compile_challenge(flag) for flag in flags)
+        self.questions = frozen_mapping(
+            {challenge.id: challenge for challenge in self.index}
+        )
+        self.positions = frozen_mapping(
+            {challenge.id: num for num, challenge in enumerate(self.index)}
+        )
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get(self, question: int) -> Optional[Challenge]:
+        return self.questions.get(question)
+
+    def position(self, question: int) -> Optional[int]:
+        return self.positions.get(question)
+
+    def at(self, num: int) -> Optional[Challenge]:
+        return self.index[num] if 0 <= num < len(self.index) else None
+
+    def sample(self) -> Challenge:
+        return SystemRandom().choice(self.index)
+
+    def page(self, offset: int, limit: int) -> List[Challenge]:
+        return list(self.index[offset : offset + limit])
+
+    @cached_property
+    def search_index(self) -> SearchIndex:
+        # Built on the first search, the question bank itself loads without it.
+        return SearchIndex(self.index)
+
+    def search(self, text: str) -> List[int]:
+        return self.search_index.search(text)
+
+    def _find(self, question: int) -> Optional[int]:
+        # Looked up in the live list, it may have changed since the last reload.
+        for num, flag in enumerate(self.flags):
+            if question_id(flag) == question:
+                return num
+        return None
+
+    def put(self, question: int, flag: dict) -> None:
+        """Replace the question with ID question, or append flag when there is none"""
+        if (num := self._find(question)) is None:
+            self.flags.append(flag)
+        else:
+            self.flags[num] = flag
+
+    def delete(self, question: int) -> Optional[dict]:
+        if (num := self._find(question)) is None:
+            return None
+        return self.flags.pop(num)
+
+
+def compile_config(config: dict, version: int = 0, bank=None) -> dict:
+    """Build the templates and question bank, bank is reused when given"""
+    if bank is None and config.get("QUESTION_STORE"):
+        # store imports utils, import it only once a store is configured.
+        from store import QuestionStore
+
+        bank = QuestionStore(config.get("QUESTION_STORE"))
+        # The YAML questions seed a new store once, afterwards the store wins.
+        bank.seed(config.get("CHALLENGE") or list())
+    config["templates"] = frozen_mapping(
+        {name: Template(config.get(name)) for name in MARKDOWN_TEMPLATES}
+    )
+    config["version"] = version
+    config["bank"] = MemoryBank(config.get("CHALLENGE")) if bank is None else bank
+    return config
+
+
+def positive(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0
+
+
+def setting_errors(config: dict, check_token: bool = True) -> List[str]:
+    """Every problem of the settings, where asserting would stop at the first
+
+    Unset settings are left to the defaults of load_config.
+    """
+    chats = config.get("CHAT")
+    overrides = config.get("CHATS")
+    checks = [
+        (not check_token or config.get("TOKEN"), "Config: No TOKEN."),
+        (
+            not chats
+            or all(
+                isinstance(chat, int)
+                for chat in (chats if isinstance(chats, list) else [chats])
+            ),
+            "Config: CHAT Must be ID, not username.",
+        ),
+        (
+            not overrides
+            or (
+                isinstance(overrides, dict)
+                and all(
+                    isinstance(chat, int) and isinstance(override, dict)
+                    for chat, override in overrides.items()
+                )
+            ),
+            "Config: CHATS Must map chat IDs to their own settings.",
+        ),
+        (
+            not config.get("SUPER_ADMIN") or isinstance(config.get("SUPER_ADMIN"), int),
+            "Config: SUPER_ADMIN Must be ID, not username.",
+        ),
+        (
+            not config.get("TIME") or positive(config.get("TIME")),
+            "Config: TIME Should be a positive number of seconds.",
+        ),
+        (
+            not config.get("BANTIME") or positive(config.get("BANTIME")),
+            "Config: BANTIME Should be a positive number of seconds.",
+        ),
+        (
+            not config.get("GREET_BATCH")
+            or (
+                isinstance(config.get("GREET_BATCH"), int)
+                and 0 < config.get("GREET_BATCH") <= 40
+            ),
+            "Config: GREET_BATCH Should be between 1 and 40.",
+        ),
+        (
+            not config.get("INGRESS_POLICY")
+            or config.get("INGRESS_POLICY") in ("oldest", "reject"),
+            "Config: INGRESS_POLICY Should be oldest or reject.",
+        ),
+        (
+            not config.get("WORKERS")
+            or (isinstance(config.get("WORKERS"), int) and config.get("WORKERS") > 0),
+            "Config: WORKERS Must be a positive integer.",
+        ),
+        (
+            not config.get("HTTP_POOL")
+            or (
+                isinstance(config.get("HTTP_POOL"), int)
+                and config.get("HTTP_POOL") > 0
+            ),
+            "Config: HTTP_POOL Must be a positive integer.",
+        ),
+        (
+            not config.get("HTTP_TIMEOUTS")
+            or isinstance(config.get("HTTP_TIMEOUTS"), dict),
+            "Config: HTTP_TIMEOUTS Should map methods to seconds.",
+        ),
+        (
+            not config.get("QUIZ")
+            or (isinstance(config.get("QUIZ"), str) and len(config.get("QUIZ")) > 2),
+            "Config: QUIZ command Should be longer than 2 chars",
+        ),
+        (
+            not config.get("RAID_THRESHOLD")
+            or (
+                isinstance(config.get("RAID_THRESHOLD"), int)
+                and config.get("RAID_THRESHOLD") > 1
+            ),
+            "Config: RAID_THRESHOLD Should be an integer larger than 1.",
+        ),
+        (
+            not config.get("ADMIN")
+            or (isinstance(config.get("ADMIN"), str) and len(config.get("ADMIN")) > 2),
+            "Config: ADMIN command Should be longer than 2 chars",
+        ),
+    ]
+    errors = [message for passed, message in checks if not passed]
+    if isinstance(overrides, dict):
+        for chat, override in overrides.items():
+            if isinstance(override, dict):
+                errors.extend(
+                    f"CHATS.{chat}: {err}"
+                    for err in setting_errors(override, check_token=False)
+                )
+    return errors
+
+
+def load_config(config: dict, check_token: bool = True, version: int = 0) -> dict:
+    errors = setting_errors(config, check_token)
+    assert not errors, "\n".join(errors)
+    if not config.get("CHAT") and not config.get("CHATS"):
         logger.warning("Config: CHAT is not set! Use /start to get one in chat.")
-    if config.get("SUPER_ADMIN"):
-        assert isinstance(
-            config.get("SUPER_ADMIN"), int
-        ), "Config: SUPER_ADMIN Must be ID, not username."
     if not config.get("TIME"):
         config["TIME"] = 120
     if not config.get("BANTIME"):
         config["BANTIME"] = 120
+    if not config.get("GREET_WINDOW"):
+        config["GREET_WINDOW"] = 0
+    if not config.get("GREET_BATCH"):
+        config["GREET_BATCH"] = 5
+    if not config.get("GLOBAL_RATE"):
+        config["GLOBAL_RATE"] = 30
+    if not config.get("CHAT_RATE"):
+        config["CHAT_RATE"] = 20
+    if not config.get("CLEAN_DELAY"):
+        config["CLEAN_DELAY"] = 1
+    if not config.get("INGRESS_QUEUE"):
+        config["INGRESS_QUEUE"] = 10000
+    if not config.get("INGRESS_MAX_AGE"):
+        config["INGRESS_MAX_AGE"] = 15
+    if not config.get("INGRESS_POLICY"):
+        config["INGRESS_POLICY"] = "oldest"
+    if not config.get("UPLOAD_LIMIT"):
+        config["UPLOAD_LIMIT"] = 10485760
+    if not config.get("UPLOAD_TIMEOUT"):
+        config["UPLOAD_TIMEOUT"] = 30
+    if not config.get("WORKERS"):
+        config["WORKERS"] = 32
+    if not config.get("HTTP_POOL_TIMEOUT"):
+        config["HTTP_POOL_TIMEOUT"] = 10
+    if not config.get("HTTP_CONNECT_TIMEOUT"):
+        config["HTTP_CONNECT_TIMEOUT"] = 5
+    if not config.get("HTTP_READ_TIMEOUT"):
+        config["HTTP_READ_TIMEOUT"] = 5
     if config.get("QUIZ"):
-        assert (
-            len(config.get("QUIZ", "")) > 2
-        ), "Config: QUIZ command Should be longer than 2 chars"
         if not config.get("QUIZTIME"):
             config["QUIZTIME"] = 1200
-    if config.get("ADMIN"):
-        assert (
-            len(config.get("ADMIN", "")) > 2
-        ), "Config: ADMIN command Should be longer than 2 chars"
+    if config.get("RAID_THRESHOLD"):
+        if not config.get("RAID_WINDOW"):
+            config["RAID_WINDOW"] = 60
+        if not config.get("RAID_TIME"):
+            config["RAID_TIME"] = 300
     if not config.get("START"):
         config["START"] = "CHAT ID: \\`{chat}\\`\nUSER ID: \\`{user}\\`"
     if not config.get("GREET"):
         config["GREET"] = "Question: {question}\nPlease answer it in {time}s."
+    if not config.get("RAID"):
+        config[
+            "RAID"
+        ] = "Too many new members, raid mode is on.\nQuestion: {question}\nEveryone who just joined must answer in {time}s or be removed."
     if not config.get("SUCCESS"):
         config["SUCCESS"] = "Succeed."
     if not config.get("RETRY"):
@@ -172,8 +668,6 @@ def load_config(config: dict, check_token: bool = True) -> dict:
         config["OTHER"] = "Don't play with buttons."
     if not config.get("RELOAD"):
         config["RELOAD"] = "Reload finished. Now there are {num} questions."
-    if not config.get("PENDING"):
-        config["PENDING"] = "Adding reload task to task list."
     if not config.get("CORRUPT"):
         config["CORRUPT"] = "The file is corrupted.\n{text}"
     if not config.get("BACK"):
@@ -193,11 +687,19 @@ def load_config(config: dict, check_token: bool = True) -> dict:
     if not config.get("START_PRIVATE"):
         config[
             "START_PRIVATE"
-        ] = "This bot is working for {link}.\n  /cancel -- exit\n  /config -- pull config\n  /reload -- reload config\nOr send config file to me directly."
+        ] = "This bot is working for {link}.\n  /cancel -- exit\n  /config -- pull config\n  /reload -- reload config\n  /search -- search questions\nOr send config file to me directly."
     if not config.get("START_UNAUTHORIZED_PRIVATE"):
         config["START_UNAUTHORIZED_PRIVATE"] = "Unauthorized request."
     if not config.get("LIST_PRIVATE"):
-        config["LIST_PRIVATE"] = "Current questions:"
+        config["LIST_PRIVATE"] = "Current questions ({total}), page {page}/{pages}:"
+    if not config.get("SEARCH_PRIVATE"):
+        config[
+            "SEARCH_PRIVATE"
+        ] = "Questions matching {text} ({total}), page {page}/{pages}:"
+    if not config.get("PREV_PAGE_BTN"):
+        config["PREV_PAGE_BTN"] = "<"
+    if not config.get("NEXT_PAGE_BTN"):
+        config["NEXT_PAGE_BTN"] = ">"
     if not config.get("EDIT_PRIVATE"):
         config["EDIT_PRIVATE"] = "Editing questions: {text}"
     if not config.get("EDIT_QUESTION_PRIVATE"):
@@ -228,46 +730,176 @@ def load_config(config: dict, check_token: bool = True) -> dict:
         config["SAVING_PRIVATE"] = "Saving..."
     if not config.get("DELETING_PRIVATE"):
         config["DELETING_PRIVATE"] = "Deleting..."
-    for flag in config.get("CHALLENGE"):
-        assert flag.get("QUESTION"), "Config: No QUESTION tile for question."
-        assert isinstance(
-            flag.get("QUESTION"), str
-        ), f"Config: QUESTION {flag.get('QUESTION')} should be string object."
-        assert flag.get(
-            "ANSWER"
-        ), f"Config: No ANSWER tile for question: {flag.get('QUESTION')}"
-        assert isinstance(
-            flag.get("ANSWER"), str
-        ), f"Config: ANSWER {flag.get('ANSWER')} should be string object for question: {flag.get('QUESTION')}"
-        assert flag.get(
-            "WRONG"
-        ), f"Config: No WRONG tile for question: {flag.get('QUESTION')}"
-        assert (
-            digest_size := len(flag.get("WRONG"))
-        ) < 20, f"Config: Too many tiles for WRONG for question: {flag.get('QUESTION')}"
-        assert all(
-            isinstance(u, str) for u in flag.get("WRONG")
-        ), f"Config: WRONG {flag.get('WRONG')} should all be string object for question: {flag.get('QUESTION')}"
-        flag.insert(
-            0,
-            "answer",
-            blake2s(
-                str(flag.get("ANSWER")).encode(),
-                salt=os.urandom(8),
-                digest_size=digest_size,
-            ).hexdigest(),
-        )
-        flag.insert(
-            0,
-            "wrong",
-            [
-                blake2s(
-                    str(flag.get("WRONG")[t]).encode(),
-                    salt=os.urandom(8),
-                    digest_size=digest_size,
-                ).hexdigest()
-                for t in range(digest_size)
-            ],
-        )
-    logger.debug(config)
+    if not config.get("CHAT_BTN"):
+        config["CHAT_BTN"] = "Chat {chat}"
+    compile_config(config, version)
+    # Each chat in CHATS overrides the shared settings, e.g. its own CHALLENGE.
+    config["chats"] = frozen_mapping(
+        {
+            chat: compile_config(
+                {
+                    **{
+                        key: value
+                        for key, value in config.items()
+                        if key != "CHATS" and key not in RUNTIME_KEYS
+                    },
+                    **override,
+                },
+                version,
+                # Chats without their own questions share the compiled bank.
+                None
+                if "CHALLENGE" in override or "QUESTION_STORE" in override
+                else config.get("bank"),
+            )
+            for chat, override in (config.get("CHATS") or dict()).items()
+        }
+    )
+    logger.debug(
+        "Config: Compiled version %s with %d questions for %d chats",
+        config.get("version"),
+        len(config.get("bank")),
+        len(config.get("chats")),
+    )
     return config
+
+
+# Keys load_config adds at runtime, never written back to the YAML file.
+RUNTIME_KEYS = ("bank", "templates", "version", "chats")
+
+
+def persisted_view(config: dict, token: str) -> dict:
+    """Shallow view of config to dump, the live structure is left untouched"""
+    view = config.copy()
+    for key in RUNTIME_KEYS:
+        view.pop(key, None)
+    # Questions are replaced rather than edited in place, copying the list is enough.
+    if "CHALLENGE" in config:
+        view["CHALLENGE"] = copy.copy(config.get("CHALLENGE"))
+    view["TOKEN"] = token
+    return view
+
+
+class ConfigWriter(object):
+    """Write configs on a background thread, coalescing repeated saves"""
+
+    def __init__(self):
+        self._pending: dict = dict()
+        self._busy = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="ConfigWriter", daemon=True
+        )
+        self._thread.start()
+
+    def save(self, config: dict, name: str, token: str) -> Future:
+        future: Future = Future()
+        view = persisted_view(config, token)
+        with self._cond:
+            # A newer save of the same file replaces the one still waiting.
+            _, futures = self._pending.get(name, (None, list()))
+            self._pending[name] = view, futures + [future]
+            self._cond.notify()
+        return future
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                name = next(iter(self._pending))
+                view, futures = self._pending.pop(name)
+                self._busy = True
+            try:
+                self._write(name, view)
+            except Exception as err:
+                logger.error(f"Config: Failed to dump {name}: {err}")
+                for future in futures:
+                    future.set_exception(err)
+            else:
+                for future in futures:
+                    future.set_result(name)
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    @staticmethod
+    def _write(name: str, view: dict) -> None:
+        temp = f"{name}.{os.getpid()}.tmp"
+        with open(temp, "w", encoding="utf-8") as file:
+            yaml.dump(view, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp, name)
+        directory = os.open(os.path.dirname(os.path.abspath(name)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        logger.info(f"Config: Dumped {name}")
+
+    def flush(self, timeout: float = 5) -> None:
+        """Block until every queued save is written, or timeout passes"""
+        deadline = time.time() + timeout
+        with self._cond:
+            while (self._pending or self._busy) and time.time() < deadline:
+                self._cond.wait(deadline - time.time())
+
+
+def chat_ids(config: dict) -> Tuple[int, ...]:
+    """Every chat served, from CHAT (an ID or a list of IDs) and CHATS"""
+    chats = config.get("CHAT") or list()
+    if not isinstance(chats, list):
+        chats = [chats]
+    return tuple(dict.fromkeys([*chats, *(config.get("CHATS") or dict())]))
+
+
+def chat_config(config: dict, chat_id: int) -> dict:
+    """Compiled settings of chat_id, the shared ones unless CHATS overrides it"""
+    return config.get("chats").get(chat_id, config)
+
+
+# Bump whenever the compiled config changes shape, older snapshots are rebuilt.
+SNAPSHOT_FORMAT = 2
+
+
+def load_snapshot(cache: str) -> tuple:
+    """mtime, digest and config pickled in cache, all None unless it is current"""
+    try:
+        with open(cache, "rb") as file:
+            snapshot_format, mtime, digest, config = pickle.load(file)
+        if snapshot_format == SNAPSHOT_FORMAT and all(
+            config.get(key) is not None for key in RUNTIME_KEYS
+        ):
+            return mtime, digest, config
+    except Exception:
+        # Missing, truncated or pickled by another version, rebuild it.
+        pass
+    return None, None, None
+
+
+def load_config_file(filename: str, check_token: bool = True) -> Tuple[dict, bool]:
+    """Load filename, reusing its compiled snapshot when the source is unchanged"""
+    cache = f"{filename}.cache"
+    mtime = os.stat(filename).st_mtime_ns
+    cached_mtime, digest, config = load_snapshot(cache)
+    if not (hit := config is not None and cached_mtime == mtime):
+        with open(filename, "rb") as file:
+            raw = file.read()
+        if not (hit := config is not None and blake2s(raw).digest() == digest):
+            digest = blake2s(raw).digest()
+            # Same content gives the same version, so a cached snapshot stays valid.
+            config = load_config(
+                yaml.load(raw.decode("utf-8")),
+                check_token=check_token,
+                version=int.from_bytes(digest[:4], "big"),
+            )
+        try:
+            # Cluster workers may rebuild at once, keep their temp files apart.
+            with open(f"{cache}.{os.getpid()}.tmp", "wb") as file:
+                pickle.dump((SNAPSHOT_FORMAT, mtime, digest, config), file)
+            os.replace(f"{cache}.{os.getpid()}.tmp", cache)
+        except OSError as err:
+            logger.warning(f"Config: Failed to write snapshot {cache}: {err}")
+    if hit and check_token:
+        assert config.get("TOKEN"), "Config: No TOKEN."
+    return config, hit